@@ -1,109 +1,212 @@
 from data import (
-    engine, Champion, BoughtItems, Match, Session, is_final_item, ItemTags)
-from sqlalchemy.sql import select, func
+    engine, Champion, BoughtItems, Match, is_final_item,
+    champion_keys, GameRollup, ItemRollup, STARTING_ITEMS_TIME, POSITIONS,
+    champion_position, same_match, patch_of, current_patches,
+    item_categories, OFFENSIVE, DEFENSIVE, CONSUMABLE)
+from sqlalchemy.sql import (
+    select, func, case, text, bindparam, true, literal, union_all)
+from sqlalchemy.dialects import sqlite
+from sqlalchemy import Integer, Float
 from datetime import datetime, timedelta
 from riot_api import CurrentVersion
+from lazy import Lazy
+from metrics import metrics
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+from math import sqrt
+
+# Version for the sql statements, fetched on first use
+current_version = Lazy(lambda: CurrentVersion().like_statement())
+# A position needs at least this many games and this share of the games of
+# the champion to get its own build
+MIN_POSITION_GAMES = 10
+MIN_POSITION_SHARE = 0.1
+# Weight of the champion's win rate in the smoothed win rates of the items,
+# as an amount of games
+PRIOR_GAMES = 20
+# Normal quantile of the confidence intervals of the win rates, 95%
+CONFIDENCE_Z = 1.96
+# Days after which the weight of a game has halved in the time decayed
+# counts, and the factor its weight is multiplied by for every patch it is
+# behind the current patch
+HALF_LIFE = 3
+PATCH_DECAY = 0.5
+
+
+def wilson_lower_bound(rate, games):
+    """ The lower end of the Wilson score interval of a rate over an amount
+        of games """
+    z2 = CONFIDENCE_Z ** 2
+    centre = rate + z2 / (2 * games)
+    spread = CONFIDENCE_Z * sqrt(
+        rate * (1 - rate) / games + z2 / (4 * games ** 2))
+    return (centre - spread) / (1 + z2 / games)
 
-current_version = CurrentVersion().like_statement()
 
 class BuildAnalyzer:
     """ A class for analyzing builds for a certain champion.
         Initialize the class with the championKey """
     championKey = None
+    position = None
     gameCount = None
+    winRate = None
 
     def __init__(self, championKey=None, days=1):
         self.championKey = championKey
         if self.championKey is None:
             raise Exception("Champion key can't be None")
         self.days = days
-        self.gameCount = self.game_count()
+        self.gameCount, self.winRate = self.game_outcomes()
         self.__cache = {}
 
-    def game_count(self):
-        s = Session()
-        gameCount = s.query(Champion).\
-            join(Match, Champion.match_id == Match.match_id).\
-            filter(Champion.champion_key == self.championKey).\
-            filter(Match.created_on > (
-                datetime.utcnow() - timedelta(days=self.days))).count()
+    @classmethod
+    def from_counts(cls, championKey, days, gameCount,
+                    starting_items, items, build_order=None, winRate=None,
+                    position=None):
+        """ Create an analyzer from item counts that have already been
+            queried, the counts are lists of (item_id, count) or (item_id,
+            count, wins, decided) tuples. The build order is queried on
+            first use if it isn't given. The position is None for the
+            games of every position """
+        analyzer = cls.__new__(cls)
+        analyzer.championKey = championKey
+        analyzer.position = position
+        analyzer.days = days
+        analyzer.gameCount = gameCount
+        analyzer.winRate = winRate
+        analyzer.__cache = {
+            "starting_items": [
+                analyzer.__item(*counts) for counts in starting_items],
+            "items": [
+                analyzer.__item(*counts)
+                for counts in items if is_final_item(counts[0])]
+        }
+        if build_order is not None:
+            analyzer.__cache["build_order"] = build_order
+        return analyzer
 
-        return gameCount
+    def __item(self, item_id, count, wins=0, decided=0):
+        """ The win rate is None without games with a known outcome, the
+            smoothed win rate is pulled towards the champion's win rate by
+            PRIOR_GAMES games. decided is the amount of games with a known
+            outcome, and the low win rate is the lower end of the Wilson
+            confidence interval of the smoothed win rate, so it is lower
+            the fewer games the item was bought in """
+        prior = 0.5 if self.winRate is None else self.winRate
+        smoothed = (wins + prior * PRIOR_GAMES) / (decided + PRIOR_GAMES)
+        return {
+            "item_id": item_id,
+            "avg_count": count / self.gameCount,
+            "percentage": count / self.gameCount * 100,
+            "decided": decided,
+            "win_rate": wins / decided if decided else None,
+            "smoothed_win_rate": smoothed,
+            "low_win_rate": wilson_lower_bound(
+                smoothed, decided + PRIOR_GAMES)
+        }
 
-    @property
-    def starting_items(self):
-        if "starting_items" in self.__cache:
-            return self.__cache["starting_items"]
+    def game_outcomes_query(self):
+        return select([
+            func.count(),
+            func.sum(Champion.winner, type_=Integer),
+            func.count(Champion.winner)]).\
+            select_from(
+                Champion.__table__.join(
+                    Match, same_match(Champion, Match))).\
+            where(Champion.champion_key == self.championKey).\
+            where(Match.created_on > (
+                datetime.utcnow() - timedelta(days=self.days)))
+
+    def game_count_query(self):
+        return self.game_outcomes_query().with_only_columns([func.count()])
 
-        s = select([
+    def game_count(self):
+        with metrics.timer("analyze.game_count"), engine.connect() as conn:
+            return conn.execute(self.game_count_query()).scalar()
+
+    def game_outcomes(self):
+        """ The number of games and the win rate of the champion in the
+            games with a known outcome, the win rate is None without any """
+        with metrics.timer("analyze.game_outcomes"), \
+                engine.connect() as conn:
+            games, wins, decided = conn.execute(
+                self.game_outcomes_query()).first()
+        return games, wins / decided if decided else None
+
+    def starting_items_query(self):
+        return select([
             Champion.champion_key,
             BoughtItems.item_id,
-            func.count(BoughtItems.item_id)]).\
+            func.count(BoughtItems.item_id),
+            func.coalesce(func.sum(Champion.winner, type_=Integer), 0),
+            func.count(Champion.winner)]).\
             distinct(BoughtItems.item_id).\
             group_by(BoughtItems.item_id).\
-            order_by(func.count(BoughtItems.item_id)).\
+            order_by(func.count(BoughtItems.item_id), BoughtItems.item_id).\
             select_from(
                 Champion.__table__.join(
                     BoughtItems,
-                    onclause=Champion.match_id == BoughtItems.match_id).join(
+                    onclause=same_match(Champion, BoughtItems)).join(
                     Match)).\
             where(Champion.champion_key == self.championKey).\
             where(Champion.participant_id == BoughtItems.participant_id).\
-            where(BoughtItems.timestamp < 110 * 1000).\
-            where(Match.version.like(current_version)).\
+            where(BoughtItems.timestamp < STARTING_ITEMS_TIME).\
+            where(Match.version.like(current_version.load())).\
             where(Match.created_on > (
                 datetime.utcnow() - timedelta(days=self.days))
         )
 
-        with engine.connect() as conn:
+    @property
+    def starting_items(self):
+        if "starting_items" in self.__cache:
+            return self.__cache["starting_items"]
+
+        with metrics.timer("analyze.starting_items"), \
+                engine.connect() as conn:
             items = []
-            result = conn.execute(s)
+            result = conn.execute(self.starting_items_query())
             for row in result:
-                items.append({
-                    "item_id": row[1],
-                    "avg_count": row[2] / self.gameCount,
-                    "percentage": row[2] / self.gameCount * 100
-                })
+                items.append(self.__item(*row[1:]))
             # Put results to cache
             self.__cache.update({"starting_items": items})
             return items
 
-    @property
-    def items(self):
-        if "items" in self.__cache:
-            return self.__cache["items"]
-
-        s = select([
+    def items_query(self):
+        return select([
             Champion.champion_key,
             BoughtItems.item_id,
-            func.count(BoughtItems.item_id)]).\
+            func.count(BoughtItems.item_id),
+            func.coalesce(func.sum(Champion.winner, type_=Integer), 0),
+            func.count(Champion.winner)]).\
             distinct(BoughtItems.item_id).\
             group_by(BoughtItems.item_id).\
-            order_by(func.count(BoughtItems.item_id)).\
+            order_by(func.count(BoughtItems.item_id), BoughtItems.item_id).\
             select_from(
                 Champion.__table__.join(
                     BoughtItems,
-                    onclause=Champion.match_id == BoughtItems.match_id).join(
+                    onclause=same_match(Champion, BoughtItems)).join(
                     Match
                 )).\
             where(Champion.champion_key == self.championKey).\
             where(Champion.participant_id == BoughtItems.participant_id).\
-            where(BoughtItems.timestamp > 110 * 1000).\
-            where(Match.version.like(current_version)).\
+            where(BoughtItems.timestamp > STARTING_ITEMS_TIME).\
+            where(Match.version.like(current_version.load())).\
             where((Match.created_on > (
                 datetime.utcnow() - timedelta(days=self.days)
             )))
 
-        with engine.connect() as conn:
+    @property
+    def items(self):
+        if "items" in self.__cache:
+            return self.__cache["items"]
+
+        with metrics.timer("analyze.items"), engine.connect() as conn:
             items = []
-            result = conn.execute(s)
+            result = conn.execute(self.items_query())
             for row in result:
                 if is_final_item(row[1]):
-                    items.append({
-                        "item_id": row[1],
-                        "avg_count": row[2] / self.gameCount,
-                        "percentage": row[2] / self.gameCount * 100
-                    })
+                    items.append(self.__item(*row[1:]))
             # Put results to cache
             self.__cache.update({"items": items})
             return items
@@ -113,8 +216,8 @@ class BuildAnalyzer:
         if "offensive_items" in self.__cache:
             return self.__cache["offensive_items"]
 
-        off = [x for x in self.items if x["item_id"]
-               in ItemTags.get_item_set(ItemTags.offensive)]
+        off = [x for x in self.items
+               if item_categories[x["item_id"]] & OFFENSIVE]
 
         self.__cache.update({"offensive_items": off})
         return off
@@ -124,8 +227,8 @@ class BuildAnalyzer:
         if "defensive_items" in self.__cache:
             return self.__cache["defensive_items"]
 
-        items = [x for x in self.items if x["item_id"]
-                 in ItemTags.get_item_set(ItemTags.defensive)]
+        items = [x for x in self.items
+                 if item_categories[x["item_id"]] & DEFENSIVE]
 
         self.__cache.update({"defensive_items": items})
         return items
@@ -135,10 +238,9 @@ class BuildAnalyzer:
         if "other" in self.__cache:
             return self.__cache["other"]
 
-        other = [item for item in self.items if item not in
-                 (self.offensive_items
-                  + self.defensive_items
-                  + self.consumables)]
+        other = [x for x in self.items
+                 if not item_categories[x["item_id"]] & (
+                     OFFENSIVE | DEFENSIVE | CONSUMABLE)]
 
         self.__cache.update({"other": other})
         return other
@@ -148,13 +250,451 @@ class BuildAnalyzer:
         if "consumables" in self.__cache:
             return self.__cache["consumables"]
 
-        consumables = [x for x in self.items if x["item_id"]
-                       in ItemTags.get_item_set(ItemTags.consumable)]
+        consumables = [x for x in self.items
+                       if item_categories[x["item_id"]] & CONSUMABLE]
 
         self.__cache.update({"consumables": consumables})
 
         return consumables
 
+    @property
+    def build_order(self):
+        """ The most common order of the first final items as a list of
+            (item_id, count) tuples """
+        if "build_order" in self.__cache:
+            return self.__cache["build_order"]
+
+        if self.position is None:
+            build_order = BuildOrderAnalyzer(
+                self.days, [self.championKey]).build_orders()[
+                    self.championKey]
+        else:
+            build_order = BuildOrderAnalyzer(
+                self.days, [self.championKey], positions=True).\
+                build_orders().get((self.championKey, self.position), [])
+
+        self.__cache.update({"build_order": build_order})
+        return build_order
+
+
+class BatchAnalyzer:
+    """ Analyzes the builds of many champions at once.
+        Instead of running separate queries for every champion the game
+        counts and the item counts are queried in one grouped pass over
+        the time window and split into a BuildAnalyzer per champion.
+        With rollups the counts are summed from the daily rollup tables
+        instead of the raw rows, the time window then starts from the
+        beginning of the day. The games can be limited to a list of
+        regions. With positions the position is an extra group key and
+        each position with enough games gets its own BuildAnalyzer """
+
+    def __init__(self, days=1, championKeys=None, rollups=False,
+                 regions=None, positions=False):
+        self.days = days
+        if championKeys is None:
+            championKeys = champion_keys()
+        self.championKeys = championKeys
+        self.rollups = rollups
+        self.regions = regions
+        self.positions = positions
+
+    def group_columns(self, champion_key, position):
+        """ The columns the counts are grouped by """
+        if self.positions:
+            return [champion_key, position]
+        return [champion_key]
+
+    def split_row(self, row):
+        """ Split a row of counts to the group key and the counts """
+        if self.positions:
+            return (row[0], row[1]), row[2:]
+        return row[0], row[1:]
+
+    def in_regions(self, column):
+        """ Condition for the region column of a query """
+        if self.regions is None:
+            return true()
+        return column.in_([region.upper() for region in self.regions])
+
+    def rollup_table(self, table, since):
+        """ The rollup table the counts are summed from """
+        return table.__table__
+
+    def rollup_sum(self, table, column, since):
+        """ Sum of a count column of a rollup table """
+        return func.sum(column)
+
+    def in_versions(self, column):
+        """ Condition for the version column of the item counts """
+        return column.like(current_version.load())
+
+    def game_counts_query(self, since):
+        group = self.group_columns(Champion.champion_key, champion_position)
+        return select(group + [
+            func.count(Champion.id),
+            func.coalesce(func.sum(Champion.winner, type_=Integer), 0),
+            func.count(Champion.winner)]).\
+            group_by(*group).\
+            select_from(
+                Champion.__table__.join(
+                    Match, same_match(Champion, Match))).\
+            where(Champion.champion_key.in_(self.championKeys)).\
+            where(self.in_regions(Match.region)).\
+            where(Match.created_on > since)
+
+    def rollup_game_counts_query(self, since):
+        group = self.group_columns(
+            GameRollup.champion_key, GameRollup.position)
+        return select(group + [
+            self.rollup_sum(GameRollup, GameRollup.games, since),
+            self.rollup_sum(GameRollup, GameRollup.wins, since),
+            self.rollup_sum(GameRollup, GameRollup.decided, since)]).\
+            select_from(self.rollup_table(GameRollup, since)).\
+            group_by(*group).\
+            where(GameRollup.champion_key.in_(self.championKeys)).\
+            where(self.in_regions(GameRollup.region)).\
+            where(GameRollup.day >= since.date())
+
+    def game_counts(self, since):
+        """ Get the amount of games played by each champion, the wins and
+            the games with a known outcome as (games, wins, decided)
+            tuples keyed by the champion key or (champion key, position) """
+        if self.rollups:
+            query = self.rollup_game_counts_query(since)
+        else:
+            query = self.game_counts_query(since)
+        with metrics.timer("analyze.game_counts"), engine.connect() as conn:
+            return dict(self.split_row(row) for row in conn.execute(query))
+
+    def item_counts_query(self, since):
+        late = case([(BoughtItems.timestamp < STARTING_ITEMS_TIME, 0)],
+                    else_=1).label("late")
+        count = func.count(BoughtItems.item_id)
+        group = self.group_columns(Champion.champion_key, champion_position)
+
+        return select(group + [
+            late,
+            BoughtItems.item_id,
+            count,
+            func.coalesce(func.sum(Champion.winner, type_=Integer), 0),
+            func.count(Champion.winner)]).\
+            group_by(*group + [late, BoughtItems.item_id]).\
+            order_by(*group + [late, count, BoughtItems.item_id]).\
+            select_from(
+                Champion.__table__.join(
+                    BoughtItems,
+                    onclause=same_match(Champion, BoughtItems)).join(
+                    Match)).\
+            where(Champion.champion_key.in_(self.championKeys)).\
+            where(Champion.participant_id == BoughtItems.participant_id).\
+            where(BoughtItems.timestamp != STARTING_ITEMS_TIME).\
+            where(Match.version.like(current_version.load())).\
+            where(self.in_regions(Match.region)).\
+            where(Match.created_on > since)
+
+    def rollup_item_counts_query(self, since):
+        count = self.rollup_sum(ItemRollup, ItemRollup.count, since)
+        group = self.group_columns(
+            ItemRollup.champion_key, ItemRollup.position)
+
+        return select(group + [
+            ItemRollup.late,
+            ItemRollup.item_id,
+            count,
+            self.rollup_sum(ItemRollup, ItemRollup.wins, since),
+            self.rollup_sum(ItemRollup, ItemRollup.decided, since)]).\
+            select_from(self.rollup_table(ItemRollup, since)).\
+            group_by(*group + [ItemRollup.late, ItemRollup.item_id]).\
+            order_by(*group + [ItemRollup.late, count, ItemRollup.item_id]).\
+            where(ItemRollup.champion_key.in_(self.championKeys)).\
+            where(self.in_versions(ItemRollup.version)).\
+            where(self.in_regions(ItemRollup.region)).\
+            where(ItemRollup.day >= since.date())
+
+    def item_counts(self, since):
+        """ Get the amount of times each item has been bought by each
+            champion. Returns a dict of (starting items, items) lists
+            of (item_id, count, wins, decided) tuples keyed by the
+            champion key or (champion key, position) """
+        if self.rollups:
+            query = self.rollup_item_counts_query(since)
+        else:
+            query = self.item_counts_query(since)
+        counts = {}
+        with metrics.timer("analyze.item_counts"), engine.connect() as conn:
+            for row in conn.execute(query):
+                key, (late, *item_counts) = self.split_row(row)
+                if key not in counts:
+                    counts[key] = ([], [])
+                counts[key][late].append(tuple(item_counts))
+        return counts
+
+    def analyzers(self):
+        """ Returns a dict of BuildAnalyzers keyed by the champion key """
+        since = datetime.utcnow() - timedelta(days=self.days)
+        game_counts = self.game_counts(since)
+        item_counts = self.item_counts(since)
+
+        build_orders = BuildOrderAnalyzer(
+            self.days, self.championKeys, regions=self.regions,
+            positions=self.positions).build_orders()
+
+        analyzers = {}
+        for key in self.groups(game_counts):
+            starting_items, items = item_counts.get(key, ([], []))
+            games, wins, decided = game_counts.get(key, (0, 0, 0))
+            championKey, position = key if self.positions else (key, None)
+            analyzers[key] = BuildAnalyzer.from_counts(
+                championKey, self.days, games, starting_items, items,
+                build_orders.get(key, []),
+                wins / decided if decided else None, position)
+        return analyzers
+
+    def groups(self, game_counts):
+        """ The keys of the analyzers, every champion key or the positions
+            of each champion with enough games """
+        if not self.positions:
+            return self.championKeys
+        totals = Counter()
+        for (key, position), (games, wins, decided) in game_counts.items():
+            totals[key] += games
+        return [
+            (key, position)
+            for key in self.championKeys for position in POSITIONS
+            if game_counts.get((key, position), (0,))[0] >= max(
+                MIN_POSITION_GAMES, totals[key] * MIN_POSITION_SHARE)
+        ]
+
+
+def patches_behind(version, patches):
+    """ How many patches a version is behind the first of the patches,
+        versions that aren't in the patches are behind all of them """
+    patch = patch_of(version)
+    if patch not in patches:
+        return len(patches)
+    return patches.index(patch)
+
+
+def decay_weight(age, behind, half_life=HALF_LIFE, patch_decay=PATCH_DECAY):
+    """ Weight of a game that is age days old and behind patches behind
+        the current patch """
+    return 0.5 ** (age / half_life) * patch_decay ** behind
+
+
+class DecayAnalyzer(BatchAnalyzer):
+    """ Analyzes the builds of many champions at once from the daily
+        rollups with each game weighted by its age, instead of only
+        counting the games of the time window and the items of the current
+        patch. The weight of a game halves every half_life days and is
+        multiplied by patch_decay for every patch it is behind the current
+        patch. The rollups are joined to the weights of their day and
+        version, so the weighted counts are summed by the database and the
+        days still give how far back the games are counted. The counts
+        are floats, the build orders aren't weighted """
+
+    def __init__(self, days=7, championKeys=None, regions=None,
+                 positions=False, half_life=HALF_LIFE,
+                 patch_decay=PATCH_DECAY):
+        super().__init__(days, championKeys, True, regions, positions)
+        self.half_life = half_life
+        self.patch_decay = patch_decay
+        self.__weight_tables = {}
+
+    def weights(self, since):
+        """ The weight of each day and of each version of the rollups in
+            the time window as two dicts """
+        patches = current_patches()
+        today = datetime.utcnow().date()
+        q = select([GameRollup.day, GameRollup.version]).\
+            distinct().\
+            where(GameRollup.day >= since.date())
+        with engine.connect() as conn:
+            rows = conn.execute(q).fetchall()
+        return (
+            {day: decay_weight((today - day).days, 0, self.half_life)
+             for day, version in rows},
+            {version: decay_weight(
+                0, patches_behind(version, patches), self.half_life,
+                self.patch_decay)
+             for day, version in rows})
+
+    def weight_tables(self, since):
+        """ Selects of the weights of the days and of the versions """
+        if since not in self.__weight_tables:
+            self.__weight_tables[since] = tuple(
+                weight_table(column, weights)
+                for column, weights in zip(("day", "version"),
+                                           self.weights(since)))
+        return self.__weight_tables[since]
+
+    def rollup_table(self, table, since):
+        days, versions = self.weight_tables(since)
+        return table.__table__.\
+            join(days, table.day == days.c.day).\
+            join(versions, table.version == versions.c.version)
+
+    def rollup_sum(self, table, column, since):
+        days, versions = self.weight_tables(since)
+        return func.sum(column * days.c.weight * versions.c.weight)
+
+    def in_versions(self, column):
+        return true()
+
+
+def weight_table(column, weights):
+    """ A select of the weight of each value of a column, a table with a
+        row that matches nothing if there are no weights """
+    if not weights:
+        weights = {None: 0.0}
+    return union_all(*[
+        select([literal(value).label(column),
+                literal(weight, Float).label("weight")])
+        for value, weight in sorted(
+            weights.items(), key=lambda item: str(item[0]))
+    ]).alias(column + "_weights")
+
+
+class BuildOrderAnalyzer:
+    """ Mines the most common orders in which champions buy their final
+        items. The purchases are read in one pass sorted by the participant
+        and the time of purchase, each participant's first depth distinct
+        final items are counted by every prefix of the sequence and the
+        build order follows the most common prefixes. With positions the
+        build orders are keyed by (champion key, position) """
+
+    def __init__(self, days=1, championKeys=None, depth=3, regions=None,
+                 positions=False):
+        self.days = days
+        if championKeys is None:
+            championKeys = champion_keys()
+        self.championKeys = championKeys
+        self.depth = depth
+        self.regions = regions
+        self.positions = positions
+
+    def purchases_query(self, since):
+        query = select([
+            Champion.champion_key,
+            champion_position,
+            BoughtItems.match_id,
+            BoughtItems.region,
+            BoughtItems.participant_id,
+            BoughtItems.item_id]).\
+            select_from(
+                Champion.__table__.join(
+                    BoughtItems,
+                    onclause=same_match(Champion, BoughtItems)).join(
+                    Match)).\
+            where(Champion.champion_key.in_(self.championKeys)).\
+            where(Champion.participant_id == BoughtItems.participant_id).\
+            where(BoughtItems.timestamp > STARTING_ITEMS_TIME).\
+            where(Match.version.like(current_version.load())).\
+            where(Match.created_on > since).\
+            order_by(
+                Champion.champion_key, Champion.match_id, Champion.region,
+                Champion.participant_id, BoughtItems.timestamp,
+                BoughtItems.item_id)
+        if self.regions is not None:
+            query = query.where(Match.region.in_(
+                [region.upper() for region in self.regions]))
+        return query
+
+    def sequences(self, since):
+        """ Yields the key and the first distinct final items bought by
+            each participant in the time window """
+        with engine.connect() as conn:
+            rows = conn.execute(self.purchases_query(since))
+            for (key, position, match_id, region, participant_id), \
+                    purchases in groupby(rows, key=itemgetter(0, 1, 2, 3, 4)):
+                sequence = []
+                for row in purchases:
+                    item_id = row[5]
+                    if item_id not in sequence and is_core_item(item_id):
+                        sequence.append(item_id)
+                        if len(sequence) == self.depth:
+                            break
+                yield (key, position) if self.positions else key, sequence
+
+    def prefix_counts(self, since):
+        """ Count every prefix of the sequences of each key """
+        counts = {} if self.positions else {
+            key: Counter() for key in self.championKeys}
+        for key, sequence in self.sequences(since):
+            if key not in counts:
+                counts[key] = Counter()
+            for length in range(1, len(sequence) + 1):
+                counts[key][tuple(sequence[:length])] += 1
+        return counts
+
+    def build_orders(self):
+        """ Returns a dict of the most common build order of each key as
+            lists of (item_id, count) tuples """
+        since = datetime.utcnow() - timedelta(days=self.days)
+        with metrics.timer("analyze.build_orders"):
+            return {
+                key: most_common_path(counts, self.depth)
+                for key, counts in self.prefix_counts(since).items()
+            }
+
+
+def is_core_item(item_id):
+    """ Final items that aren't consumables """
+    return is_final_item(item_id) and \
+        not item_categories.get(int(item_id), 0) & CONSUMABLE
+
+
+def most_common_path(prefix_counts, depth):
+    """ Follow the most common prefix from the empty prefix one item at a
+        time, ties go to the lower item id """
+    children = {}
+    for prefix, count in prefix_counts.items():
+        children.setdefault(prefix[:-1], []).append((-count, prefix[-1]))
+    path = ()
+    order = []
+    for _ in range(depth):
+        if path not in children:
+            break
+        count, item_id = min(children[path])
+        path += (item_id,)
+        order.append((item_id, -count))
+    return order
+
+
+def query_plan(statement):
+    """ Get the steps of the sqlite query plan for a statement """
+    compiled = statement.compile(dialect=sqlite.dialect(paramstyle="named"))
+    explain = text("EXPLAIN QUERY PLAN " + str(compiled)).bindparams(*[
+        bindparam(key, value, type_=compiled.binds[key].type)
+        for key, value in compiled.params.items()])
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.execute(explain)]
+
+
+def full_table_scans(championKey, days=1):
+    """ Get the steps of the analyzer query plans that scan a whole
+        table instead of using an index, keyed by the query name """
+    analyzer = BuildAnalyzer.from_counts(championKey, days, 0, [], [])
+    batch = BatchAnalyzer(days)
+    since = datetime.utcnow() - timedelta(days=days)
+    queries = {
+        "game_outcomes": analyzer.game_outcomes_query(),
+        "starting_items": analyzer.starting_items_query(),
+        "items": analyzer.items_query(),
+        "game_counts": batch.game_counts_query(since),
+        "item_counts": batch.item_counts_query(since),
+        "rollup_game_counts": batch.rollup_game_counts_query(since),
+        "rollup_item_counts": batch.rollup_item_counts_query(since),
+        "purchases": BuildOrderAnalyzer(days).purchases_query(since)
+    }
+
+    scans = {}
+    for name, statement in queries.items():
+        steps = [step for step in query_plan(statement)
+                 if step.startswith("SCAN") and "INDEX" not in step]
+        if steps:
+            scans[name] = steps
+    return scans
+
 
 if __name__ == '__main__':
     b = BuildAnalyzer("Azir")
@@ -0,0 +1,1448 @@
+""" Benchmarks for the slow parts of generating the item sets.
+    Run with the name of the benchmark, for example:
+
+        python benchmark.py analyze 7
+"""
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+import argparse
+import gzip
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def timed(function, *args, **kwargs):
+    """ Run the function and return its result and the time it took """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+@contextmanager
+def scratch_database():
+    """ Give the benchmark its own empty database in a temporary directory
+        instead of the real data.db. Has to be entered before the data
+        module is imported """
+    if "data" in sys.modules:
+        raise Exception("scratch_database must be used before importing data")
+    with tempfile.TemporaryDirectory() as path:
+        os.environ["CB_DATABASE"] = os.path.join(path, "data.db")
+        import data
+        data.create_db_from_scratch()
+        try:
+            yield
+        finally:
+            data.engine.dispose()
+
+
+def catalog_ids():
+    """ Get the champion and item ids of the static data """
+    import data
+
+    champion_ids = sorted(int(key) for key in data.champions["data"])
+    item_ids = sorted(int(key) for key in data.items["data"])
+    return champion_ids, item_ids
+
+
+def load_synthetic(count):
+    """ Load count synthetic matches of the current version played now to
+        the scratch database, returns the matches """
+    import data
+    from riot_api import CurrentVersion
+    from synthetic import synthetic_matches
+
+    champion_ids, item_ids = catalog_ids()
+    version = str(CurrentVersion()) + ".1"
+    matches = list(synthetic_matches(
+        count, champion_ids, item_ids,
+        created_on=int(time.time() * 1000), version=version))
+    data.stream_loader(matches)
+    return matches
+
+
+@contextmanager
+def synthetic_static_data():
+    """ Answer the versions, champion and item data from the synthetic
+        static data in a temporary response cache instead of the api """
+    import riot_api
+    from cache import ResponseCache
+    from synthetic import VERSIONS, synthetic_champions, synthetic_items
+
+    conf = riot_api.get_config()
+    cache, offline = conf.cache, conf.offline
+    with tempfile.TemporaryDirectory() as path:
+        conf.cache = ResponseCache(path)
+        conf.offline = True
+        conf.cache.put("versions", "versions", VERSIONS)
+        conf.cache.put("champion", VERSIONS[0], synthetic_champions())
+        conf.cache.put("item", VERSIONS[0], synthetic_items())
+        try:
+            yield
+        finally:
+            conf.cache, conf.offline = cache, offline
+
+
+def git_commit():
+    """ The commit of the working tree, None outside of a git checkout """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_stages(count, days, chunk_size, output=None, compare=None):
+    """ Time each stage of making the item sets from count full synthetic
+        matches spread over the last days: decoding the responses,
+        parsing the purchases, loading the matches, the analysis per
+        champion and in a batch, building the item sets and writing the
+        zip file. Needs no api key, the results are saved as json """
+    stages = dict.fromkeys([
+        "decode", "parse", "ingest", "analysis_per_champion",
+        "analysis_batch", "item_sets", "zip"], 0.0)
+    with synthetic_static_data(), scratch_database(), \
+            tempfile.TemporaryDirectory() as path:
+        import data
+        import riot_api
+        from analyze import BatchAnalyzer, BuildAnalyzer
+        from item_set import ItemSetBuilder, create_zipfile
+        from synthetic import synthetic_matches
+
+        champion_ids, item_ids = catalog_ids()
+        version = str(riot_api.CurrentVersion()) + ".1"
+        span = days * 24 * 60 * 60 * 1000
+        spacing = span // count
+        first = int(time.time() * 1000) - span + spacing
+        events = 0
+        for start in range(0, count, chunk_size):
+            bodies = [json.dumps(match).encode() for match in synthetic_matches(
+                min(chunk_size, count - start), champion_ids, item_ids,
+                created_on=first + start * spacing, version=version,
+                start=start + 1, full=True, spacing=spacing)]
+            matches, seconds = timed(
+                lambda: [riot_api.parse_match(body) for body in bodies])
+            stages["decode"] += seconds
+            purchases, seconds = timed(
+                lambda: [data.get_items_bought(match) for match in matches])
+            stages["parse"] += seconds
+            events += sum(map(len, purchases))
+            stages["ingest"] += timed(data.match_loader, matches)[1]
+
+        def per_champion():
+            for key in data.champion_keys():
+                analyzer = BuildAnalyzer(key, days)
+                analyzer.starting_items, analyzer.items, analyzer.build_order
+
+        stages["analysis_per_champion"] = timed(per_champion)[1]
+        analyzers, stages["analysis_batch"] = timed(
+            BatchAnalyzer(days).analyzers)
+        stages["item_sets"] = timed(lambda: [
+            ItemSetBuilder(analyzer).generate()
+            for analyzer in analyzers.values()])[1]
+        stages["zip"] = timed(
+            create_zipfile, os.path.join(path, "item_set.zip"), days)[1]
+
+    result = {
+        "count": count,
+        "days": days,
+        "purchases": events,
+        "created": datetime.utcnow().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "stages": stages,
+    }
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    previous = None
+    if compare is not None:
+        with open(compare) as f:
+            previous = json.load(f)["stages"]
+    print()
+    for stage, seconds in stages.items():
+        line = "{0:<22}{1:9.3f} s".format(stage, seconds)
+        if previous is not None and previous.get(stage):
+            line += "  {0:.2f}x of {1:.3f} s".format(
+                seconds / previous[stage], previous[stage])
+        print(line)
+
+
+def bench_analyze(days):
+    """ Compare building every item set with a BuildAnalyzer per champion
+        against building them from a single BatchAnalyzer """
+    from analyze import BuildAnalyzer, BatchAnalyzer
+    from item_set import ItemSetBuilder
+    from data import champion_keys
+
+    def per_champion():
+        return [json.dumps(
+            ItemSetBuilder(BuildAnalyzer(key, days)).generate(), indent=2)
+            for key in champion_keys()]
+
+    def batch():
+        analyzers = BatchAnalyzer(days).analyzers()
+        return [json.dumps(
+            ItemSetBuilder(analyzers[key]).generate(), indent=2)
+            for key in champion_keys()]
+
+    expected, per_champion_time = timed(per_champion)
+    result, batch_time = timed(batch)
+    if result != expected:
+        raise Exception("Batch analyzer output differs from BuildAnalyzer")
+
+    print("Per champion: {0:.3f} s".format(per_champion_time))
+    print("Batch:        {0:.3f} s".format(batch_time))
+    print("Speedup:      {0:.1f}x".format(per_champion_time / batch_time))
+
+
+def bench_workers(days, worker_counts):
+    """ Time creating the item set zip file with different amounts of
+        worker processes, and check that every zip file has the same bytes
+        as the one of the first amount of workers """
+    from item_set import create_zipfile
+
+    with tempfile.TemporaryDirectory() as path:
+        times = {}
+        contents = {}
+        for index, workers in enumerate(worker_counts):
+            # The zip files are written more than the two seconds apart
+            # that the dates in a zip file can tell apart
+            if index:
+                time.sleep(2)
+            # A zip file of its own so no item sets are copied from the
+            # zip file of the last run
+            zip_path = os.path.join(path, "item_set_{0}.zip".format(workers))
+            times[workers] = timed(create_zipfile, zip_path, days, workers)[1]
+            with open(zip_path, "rb") as f:
+                contents[workers] = f.read()
+
+    for workers in worker_counts:
+        if contents[workers] != contents[worker_counts[0]]:
+            raise Exception(
+                "The zip file of {0} workers differs from the zip file of "
+                "{1}".format(workers, worker_counts[0]))
+
+    for workers in worker_counts:
+        print("{0} workers: {1:.2f} s ({2:.1f}x)".format(
+            workers, times[workers], times[worker_counts[0]] / times[workers]))
+
+
+def bench_categorize(count):
+    """ Compare categorizing count bought items by scanning the item data
+        for every item against looking them up from the item index """
+    import random
+    from data import ItemTags, item_categories, items, is_final_item
+    from data import OFFENSIVE, DEFENSIVE, CONSUMABLE
+
+    final_ids = [int(key) for key in items["data"] if is_final_item(key)]
+    rows = [{"item_id": random.choice(final_ids)} for i in range(count)]
+
+    def scanning():
+        off = [x for x in rows if x["item_id"]
+               in ItemTags.get_item_set(ItemTags.offensive)]
+        defensive = [x for x in rows if x["item_id"]
+                     in ItemTags.get_item_set(ItemTags.defensive)]
+        consumables = [x for x in rows if x["item_id"]
+                       in ItemTags.get_item_set(ItemTags.consumable)]
+        other = [x for x in rows if x not in off + defensive + consumables]
+        return off, defensive, consumables, other
+
+    def indexed():
+        def category(flags):
+            return [x for x in rows if item_categories[x["item_id"]] & flags]
+        other = [x for x in rows if not item_categories[x["item_id"]] & (
+            OFFENSIVE | DEFENSIVE | CONSUMABLE)]
+        return (category(OFFENSIVE), category(DEFENSIVE),
+                category(CONSUMABLE), other)
+
+    item_categories.load()
+    expected, scanning_time = timed(scanning)
+    result, indexed_time = timed(indexed)
+    if result != expected:
+        raise Exception("Item index categories differ from the item data")
+
+    print("{0} items, catalog of {1} items".format(count, len(final_ids)))
+    print("Scanning the item data: {0:.4f} s".format(scanning_time))
+    print("Item index:             {0:.4f} s".format(indexed_time))
+
+
+def bench_load(count, batch_size):
+    """ Load count synthetic matches to an empty database and report
+        the rows loaded per second """
+    with scratch_database():
+        import data
+        from synthetic import synthetic_matches
+
+        champion_ids, item_ids = catalog_ids()
+        rows = 0
+        seconds = 0
+        batch = []
+        matches = synthetic_matches(count, champion_ids, item_ids)
+        for index, match in enumerate(matches, start=1):
+            batch.append(data.match_rows(match))
+            if len(batch) == batch_size or index == count:
+                rows += sum(1 + len(participants) + len(items)
+                            for match_row, participants, items in batch)
+                seconds += timed(data.rows_loader, batch)[1]
+                batch = []
+
+    print("Loaded {0} matches, {1} rows in {2:.2f} s".format(
+        count, rows, seconds))
+    print("{0:.0f} rows/s".format(rows / seconds))
+
+
+def bench_snapshot(count):
+    """ Compare the BuildAnalyzers from a snapshot of count synthetic
+        matches to the ones from the database """
+    with scratch_database(), tempfile.TemporaryDirectory() as directory:
+        from analyze import BatchAnalyzer, BuildAnalyzer
+        from snapshot import export_snapshot, Snapshot, SnapshotAnalyzer
+
+        load_synthetic(count)
+        export_time = timed(export_snapshot, directory)[1]
+        size = sum(os.path.getsize(os.path.join(directory, name))
+                   for name in os.listdir(directory))
+
+        batch, batch_time = timed(BatchAnalyzer(1).analyzers)
+        snapshot, snapshot_time = timed(
+            lambda: SnapshotAnalyzer(Snapshot(directory), 1).analyzers())
+        for key, analyzer in snapshot.items():
+            expected = BuildAnalyzer(key, 1)
+            if analyzer.gameCount != expected.gameCount or \
+                    analyzer.items != expected.items or \
+                    analyzer.starting_items != expected.starting_items:
+                raise Exception("Snapshot analysis of {0} differs".format(key))
+
+    print("Exported {0} matches to {1:.1f} MB in {2:.2f} s".format(
+        count, size / 1024 / 1024, export_time))
+    print("Batch analyzer:    {0:.3f} s".format(batch_time))
+    print("Snapshot analyzer: {0:.3f} s".format(snapshot_time))
+    print("Snapshot analysis matches the BuildAnalyzers")
+
+
+def parse_fixtures(directory, count):
+    """ Response bodies of matches with timelines, recorded ones from the
+        json files in the directory or count full synthetic matches """
+    if directory is not None:
+        bodies = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".json"):
+                with open(os.path.join(directory, name), "rb") as f:
+                    bodies.append(f.read())
+        return bodies
+    from synthetic import synthetic_matches
+
+    champion_ids, item_ids = catalog_ids()
+    return [json.dumps(match).encode() for match in synthetic_matches(
+        count, champion_ids, item_ids, full=True)]
+
+
+def bench_parse(directory, count):
+    """ Compare parsing match responses to rows with the whole json
+        document and with the pruning parser """
+    import tracemalloc
+    import data
+    import riot_api
+
+    bodies = parse_fixtures(directory, count)
+    paths = [
+        ("Whole document", lambda body: data.match_rows(json.loads(body))),
+        ("Pruning parser",
+         lambda body: data.match_rows(riot_api.parse_match(body))),
+    ]
+    results = []
+    for name, parse in paths:
+        rows, seconds = timed(lambda: [parse(body) for body in bodies])
+        peak = 0
+        tracemalloc.start()
+        for body in bodies:
+            tracemalloc.reset_peak()
+            parse(body)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        results.append(rows)
+        print("{0}: {1:.3f} s, peak {2:.1f} MB per match".format(
+            name, seconds, peak / 1024 / 1024))
+
+    if results[0] != results[1]:
+        raise Exception("The pruning parser gives different rows")
+    print("{0} matches, {1:.1f} MB of responses, the rows are the same"
+          .format(len(bodies), sum(map(len, bodies)) / 1024 / 1024))
+
+
+def bench_build_orders(count):
+    """ Mine the build orders of count synthetic matches in one pass and
+        per champion, and check them against counting the sequences
+        straight from the matches """
+    with scratch_database():
+        import data
+        from analyze import (
+            BuildOrderAnalyzer, is_core_item, most_common_path)
+        from collections import Counter
+
+        matches = load_synthetic(count)
+        keys = data.champion_keys()
+
+        batch, batch_time = timed(BuildOrderAnalyzer(1, keys).build_orders)
+        single_time = 0
+        for key in keys:
+            orders, seconds = timed(
+                BuildOrderAnalyzer(1, [key]).build_orders)
+            single_time += seconds
+            if orders[key] != batch[key]:
+                raise Exception("Build orders of {0} differ".format(key))
+
+        expected = {key: Counter() for key in keys}
+        for match in matches:
+            _, participants, items = data.match_rows(match)
+            champions = {participant["participant_id"]:
+                         participant["champion_key"]
+                         for participant in participants}
+            sequences = {}
+            for item in sorted(items, key=lambda item: (
+                    item["timestamp"], item["item_id"])):
+                sequence = sequences.setdefault(item["participant_id"], [])
+                if item["timestamp"] > data.STARTING_ITEMS_TIME and \
+                        len(sequence) < 3 and \
+                        item["item_id"] not in sequence and \
+                        is_core_item(item["item_id"]):
+                    sequence.append(item["item_id"])
+            for participant_id, sequence in sequences.items():
+                for length in range(1, len(sequence) + 1):
+                    expected[champions[participant_id]][
+                        tuple(sequence[:length])] += 1
+        for key in keys:
+            if most_common_path(expected[key], 3) != batch[key]:
+                raise Exception(
+                    "Build order of {0} differs from the matches".format(key))
+
+    print("One pass:     {0:.3f} s".format(batch_time))
+    print("Per champion: {0:.3f} s".format(single_time))
+    print("Build orders match the sequences of the matches")
+
+
+# Fewer matches make the queries so short that the fixed cost of running
+# them decides the comparison of the outcomes benchmark, and with fewer
+# rounds a single slow round can still be the median
+MIN_OUTCOMES_COUNT = 5000
+MIN_OUTCOMES_REPEAT = 9
+
+
+def bench_outcomes(count, repeat):
+    """ Time the grouped item count query of count synthetic matches with
+        and without the win and outcome aggregates, fail if the outcomes
+        make the query more than 10% slower in the median round """
+    with scratch_database():
+        import data
+        from analyze import BatchAnalyzer
+        from datetime import datetime, timedelta
+
+        load_synthetic(count)
+        since = datetime.utcnow() - timedelta(days=1)
+        query = BatchAnalyzer(1).item_counts_query(since)
+        # The same query without the last two columns, wins and decided
+        counts_only = query.with_only_columns(list(query.inner_columns)[:-2])
+
+        # The queries take turns so that both see the same cache, and the
+        # first round only warms it up. Each round is compared on its own
+        # and the median of the rounds is taken, so that a single slow
+        # round on a busy machine doesn't decide the result.
+        statements = (counts_only, query)
+        rounds = []
+        with data.engine.connect() as conn:
+            for i in range(repeat + 1):
+                times = tuple(
+                    timed(lambda: conn.execute(statement).fetchall())[1]
+                    for statement in statements)
+                if i:
+                    rounds.append(times)
+        rounds.sort(key=lambda times: times[1] / times[0])
+        without_time, with_time = rounds[len(rounds) // 2]
+
+    print("Counts only:       {0:.3f} s".format(without_time))
+    print("With the outcomes: {0:.3f} s".format(with_time))
+    print("{0:+.1f}% (median of {1} rounds)".format(
+        (with_time / without_time - 1) * 100, repeat))
+    if with_time > without_time * 1.1:
+        raise Exception("The outcomes make the query over 10% slower")
+
+
+def bench_positions(count):
+    """ Time splitting the counts of count synthetic matches by position
+        against the counts of whole champions, and check the position
+        counts against counting straight from the matches """
+    with scratch_database():
+        import data
+        from analyze import BatchAnalyzer
+        from collections import Counter
+        from datetime import datetime, timedelta
+
+        matches = load_synthetic(count)
+        since = datetime.utcnow() - timedelta(days=1)
+
+        champions = BatchAnalyzer(1)
+        positions = BatchAnalyzer(1, positions=True)
+        champions_time = timed(champions.item_counts, since)[1]
+        item_counts, positions_time = timed(positions.item_counts, since)
+        game_counts = positions.game_counts(since)
+
+        expected_games = Counter()
+        expected_items = Counter()
+        for match in matches:
+            _, participants, items = data.match_rows(match)
+            keys = {}
+            for participant in participants:
+                key = (participant["champion_key"], data.position_of(
+                    participant["role"], participant["lane"]))
+                keys[participant["participant_id"]] = key
+                expected_games[key] += 1
+            for item in items:
+                if item["timestamp"] != data.STARTING_ITEMS_TIME:
+                    late = int(item["timestamp"] > data.STARTING_ITEMS_TIME)
+                    expected_items[keys[item["participant_id"]] + (
+                        late, item["item_id"])] += 1
+
+    games = {key: counts[0] for key, counts in game_counts.items()}
+    items = {
+        key + (late, item_id): counts[0]
+        for key, lists in item_counts.items()
+        for late, bought in enumerate(lists)
+        for item_id, *counts in bought
+    }
+    if games != dict(expected_games) or items != dict(expected_items):
+        raise Exception("Position counts differ from the matches")
+    print("By champion: {0:.3f} s".format(champions_time))
+    print("By position: {0:.3f} s".format(positions_time))
+    print("Position counts match the matches")
+
+
+def bench_decay(count, days, half_life, patch_decay):
+    """ Time the time decayed counts of count synthetic matches spread over
+        the days and two patches against the plain rollup counts, and check
+        them against weighting every match by itself """
+    with scratch_database():
+        import data
+        from analyze import (
+            BatchAnalyzer, DecayAnalyzer, decay_weight, patch_of,
+            patches_behind)
+        from item_set import BatchItemSetBuilder
+        from collections import Counter
+        from datetime import datetime, timedelta
+        from riot_api import get_versions
+        from synthetic import synthetic_matches
+
+        champion_ids, item_ids = catalog_ids()
+        patches = []
+        for version in get_versions():
+            if patch_of(version) not in patches:
+                patches.append(patch_of(version))
+        span = days * 24 * 60 * 60 * 1000
+        spacing = span // count
+        first = int(time.time() * 1000) - span + spacing
+        # The older half of the matches is from the previous patch, which
+        # had an item that was removed from the item data of the current one
+        removed_item = max(item_ids) + 1
+        catalogs = [item_ids + [removed_item], item_ids]
+        matches = []
+        for half, patch in enumerate(reversed(patches[:2])):
+            start = half * (count // 2)
+            matches.extend(synthetic_matches(
+                count // 2, champion_ids, catalogs[half],
+                created_on=first + start * spacing, version=patch + ".1.1",
+                start=start + 1, spacing=spacing))
+        data.stream_loader(matches)
+        since = datetime.utcnow() - timedelta(days=days)
+
+        plain = BatchAnalyzer(days, rollups=True)
+        decayed = DecayAnalyzer(
+            days, half_life=half_life, patch_decay=patch_decay)
+        plain_time = timed(plain.item_counts, since)[1]
+        item_counts, decay_time = timed(decayed.item_counts, since)
+        game_counts = decayed.game_counts(since)
+        # The removed item is counted but isn't final, so it stays out of
+        # the item sets
+        item_sets = BatchItemSetBuilder(
+            decayed.analyzers().values()).generate()
+
+        today = datetime.utcnow().date()
+        expected_games = Counter()
+        expected_items = Counter()
+        for match in matches:
+            match_row, participants, items = data.match_rows(match)
+            day = match_row["created_on"].date()
+            if day < since.date():
+                continue
+            weight = decay_weight(
+                (today - day).days,
+                patches_behind(match_row["version"], patches),
+                half_life, patch_decay)
+            keys = {}
+            for participant in participants:
+                keys[participant["participant_id"]] = \
+                    participant["champion_key"]
+                expected_games[participant["champion_key"]] += weight
+            for item in items:
+                if item["timestamp"] != data.STARTING_ITEMS_TIME:
+                    late = int(item["timestamp"] > data.STARTING_ITEMS_TIME)
+                    expected_items[keys[item["participant_id"]], late,
+                                   item["item_id"]] += weight
+
+    games = {key: counts[0] for key, counts in game_counts.items()}
+    items = {
+        (key, late, item_id): counts[0]
+        for key, lists in item_counts.items()
+        for late, bought in enumerate(lists)
+        for item_id, *counts in bought
+    }
+
+    def close(counts, expected):
+        return counts.keys() == expected.keys() and all(
+            abs(counts[key] - expected[key]) <= 1e-9 * max(1, expected[key])
+            for key in expected)
+
+    if not close(games, expected_games) or not close(items, expected_items):
+        raise Exception("Decayed counts differ from weighting the matches")
+    if any(item["id"] == str(removed_item) for item_set in item_sets
+           for block in item_set["blocks"] for item in block["items"]):
+        raise Exception("An item of the previous patch is in the item sets")
+    print("Plain rollups: {0:.3f} s".format(plain_time))
+    print("Time decayed:  {0:.3f} s".format(decay_time))
+    print("Decayed counts match weighting every match")
+
+
+def bench_item_sets(variants, rank):
+    """ Time building the item sets of variants analyzers of random item
+        counts with an ItemSetBuilder per analyzer against building them
+        all at once, and check that the item sets are the same """
+    import random
+    from analyze import BuildAnalyzer
+    from item_set import ItemSetBuilder, BatchItemSetBuilder
+
+    champion_ids, item_ids = catalog_ids()
+    generator = random.Random(variants)
+    counts = []
+    for variant in range(variants):
+        games = generator.randint(20, 500)
+        starting_items = [
+            (item_id, generator.randint(1, games), 0, 0)
+            for item_id in generator.sample(item_ids, 6)]
+        items = []
+        for item_id in generator.sample(item_ids, 40):
+            count = generator.randint(1, games)
+            wins = generator.randint(0, count)
+            items.append((item_id, count, wins, count))
+        items.sort(key=lambda item: (item[1], item[0]))
+        counts.append(("Champion{0}".format(variant), games,
+                       starting_items, items, 0.5))
+
+    def analyzers():
+        return [BuildAnalyzer.from_counts(
+                    key, 7, games, starting_items, items, [], win_rate)
+                for key, games, starting_items, items, win_rate in counts]
+
+    single, single_time = timed(
+        lambda variants: [
+            ItemSetBuilder(analyzer, rank).generate()
+            for analyzer in variants], analyzers())
+    batch, batch_time = timed(
+        lambda variants: BatchItemSetBuilder(variants, rank).generate(),
+        analyzers())
+
+    if single != batch:
+        raise Exception("The batch builder gives different item sets")
+    print("Per analyzer: {0:.3f} s".format(single_time))
+    print("Batch:        {0:.3f} s".format(batch_time))
+    print("Speedup:      {0:.1f}x".format(single_time / batch_time))
+
+
+def check_query_plans(count):
+    """ Fail if any of the analyzer queries does a full table scan on a
+        database of count synthetic matches """
+    with scratch_database():
+        import data
+        from analyze import full_table_scans
+        from synthetic import synthetic_matches
+
+        champion_ids, item_ids = catalog_ids()
+        data.stream_loader(synthetic_matches(count, champion_ids, item_ids))
+        with data.engine.connect() as conn:
+            conn.execute("ANALYZE")
+        scans = full_table_scans(data.champion_keys()[0])
+
+    for name, steps in sorted(scans.items()):
+        print("{0}: {1}".format(name, "; ".join(steps)))
+    if scans:
+        raise Exception("Analyzer queries fall back to full table scans")
+    print("No full table scans")
+
+
+def bench_rollups(count, steps):
+    """ Grow the history one day of count synthetic matches at a time
+        and time analyzing the last day from the raw rows and from the
+        rollups, then check that the rollups match the raw rows """
+    with scratch_database():
+        import data
+        from analyze import BatchAnalyzer
+        from riot_api import CurrentVersion
+        from synthetic import synthetic_matches
+
+        champion_ids, item_ids = catalog_ids()
+        version = str(CurrentVersion()) + ".1"
+        now = int(time.time() * 1000)
+        for step in range(steps):
+            # Every step adds an older day of matches
+            created_on = now - (step + 1) * 24 * 60 * 60 * 1000
+            data.stream_loader(synthetic_matches(
+                count, champion_ids, item_ids, created_on=created_on,
+                version=version, start=step * count + 1))
+            raw_time = timed(BatchAnalyzer(1).analyzers)[1]
+            rollup_time = timed(BatchAnalyzer(1, rollups=True).analyzers)[1]
+            print("{0} days of history: raw {1:.3f} s, rollups {2:.3f} s"
+                  .format(step + 1, raw_time, rollup_time))
+
+        differences = data.check_rollups()
+    if differences:
+        raise Exception("Rollups differ from the raw rows: {0}".format(
+            differences))
+    print("Rollups match the raw rows")
+
+
+def bench_retention(count, days, retain_days):
+    """ Load count synthetic matches spread over the days, expire the
+        bought items older than retain_days to weekly archives and compact
+        the database. Compares the size of the database and the time of
+        analyzing the kept days before and after, and checks that the
+        rollups didn't change and that every removed item is archived """
+    with scratch_database(), tempfile.TemporaryDirectory() as archive:
+        import data
+        from analyze import BatchAnalyzer
+        from datetime import datetime, timedelta
+        from riot_api import CurrentVersion
+        from synthetic import synthetic_matches
+
+        champion_ids, item_ids = catalog_ids()
+        span = days * 24 * 60 * 60 * 1000
+        spacing = span // count
+        data.stream_loader(synthetic_matches(
+            count, champion_ids, item_ids,
+            created_on=int(time.time() * 1000) - span + spacing,
+            version=str(CurrentVersion()) + ".1", spacing=spacing))
+        # Start from a compact database like after a vacuum
+        data.compact()
+
+        def rollups():
+            with data.engine.connect() as conn:
+                return [
+                    sorted(conn.execute(data.select(list(table.columns))))
+                    for table in (data.GameRollup.__table__,
+                                  data.ItemRollup.__table__)]
+
+        def item_rows(connection):
+            return sorted(connection.execute(
+                "SELECT * FROM bought_items").fetchall())
+
+        def analyze():
+            analyzer = BatchAnalyzer(retain_days)
+            since = datetime.utcnow() - timedelta(days=retain_days)
+            return timed(lambda: (
+                analyzer.game_counts(since), analyzer.item_counts(since)))
+
+        with data.engine.connect() as conn:
+            items_before = item_rows(conn)
+        rollups_before = rollups()
+        counts_before, analyze_before = analyze()
+        removed, expire_time = timed(
+            data.expire_bought_items, retain_days, None, archive)
+        (size_before, size_after), compact_time = timed(data.compact)
+        counts_after, analyze_after = analyze()
+
+        with data.engine.connect() as conn:
+            kept = item_rows(conn)
+        archives = sorted(os.listdir(archive))
+        archived = []
+        for name in archives:
+            connection = sqlite3.connect(os.path.join(archive, name))
+            archived.extend(item_rows(connection))
+            connection.close()
+        if rollups() != rollups_before:
+            raise Exception("Expiring the bought items changed the rollups")
+        if len(archived) != removed or \
+                sorted(kept + archived) != items_before:
+            raise Exception("The removed items weren't archived")
+        if counts_after != counts_before:
+            raise Exception("Expiring changed the counts of the kept days")
+
+    print("Expired {0} of {1} bought items to {2} weekly archives in "
+          "{3:.3f} s".format(
+              removed, len(items_before), len(archives), expire_time))
+    print("Compacted in {0:.3f} s: {1:.1f} MB -> {2:.1f} MB".format(
+        compact_time, size_before / 1e6, size_after / 1e6))
+    print("Analyzing {0} days: {1:.3f} s before, {2:.3f} s after".format(
+        retain_days, analyze_before, analyze_after))
+    print("Rollups unchanged and every removed item is archived")
+
+
+# Makes every attempt to open a connection fail
+NO_NETWORK = """
+import socket
+def no_network(*args, **kwargs):
+    raise Exception("Network access while importing")
+socket.socket.connect = no_network
+socket.create_connection = no_network
+"""
+
+
+def bench_imports(module):
+    """ Import the module in a new interpreter with -X importtime, in an
+        empty directory without an api key and with the network blocked,
+        and report how long importing the modules of this project took """
+    project = os.path.dirname(os.path.abspath(__file__))
+    modules = {name[:-3] for name in os.listdir(project)
+               if name.endswith(".py")}
+    env = dict(os.environ, PYTHONPATH=project)
+    with tempfile.TemporaryDirectory() as path:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c",
+             NO_NETWORK + "import " + module],
+            cwd=path, env=env, stderr=subprocess.PIPE,
+            universal_newlines=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise Exception("Importing {0} failed".format(module))
+
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() in modules:
+            print("{0:<12} self {1:8.1f} ms  cumulative {2:8.1f} ms".format(
+                name.strip(), int(own) / 1000, int(cumulative) / 1000))
+
+
+class StubRiotServer(ThreadingMixIn, HTTPServer):
+    """ Local stand-in for the Riot api that enforces the rate limits of
+        each region separately. Challenger league, matchlist and match
+        requests are answered with small documents after the latency of
+        the region or with a 429 if a limit of the region was exceeded """
+    daemon_threads = True
+
+    def __init__(self, limits, latency=0.05, summoners=10,
+                 matches_per_summoner=10, match_document=None,
+                 fail_every=None, bandwidth=None, shared_ids=False):
+        super().__init__(("127.0.0.1", 0), StubRiotHandler)
+        self.limits = limits
+        # Latency in seconds, or a dict of latencies keyed by the region
+        self.latency = latency
+        self.summoners = summoners
+        self.matches_per_summoner = matches_per_summoner
+        # Function from a region and a match id to a whole match document
+        self.match_document = match_document
+        # Answer every fail_every request with a 503
+        self.fail_every = fail_every
+        self.served = 0
+        # Bytes per second sent over a connection, None for no limit
+        self.bandwidth = bandwidth
+        # Encoded match documents by the path and the encoding, matches
+        # never change so each is only encoded once
+        self.bodies = {}
+        # The games of each summoner are a second apart from an hour ago,
+        # raising matches_per_summoner adds newer games
+        self.start = int(time.time() - 60 * 60) * 1000
+        self.matchlist_entries = 0
+        # The match ids of each region are from their own range, with
+        # shared_ids every region has the same ids for its own games
+        self.shared_ids = shared_ids
+        self.first_match_ids = {}
+        self.requests = {}
+        self.status_counts = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_port)
+
+    def region_latency(self, region):
+        if isinstance(self.latency, dict):
+            return self.latency[region]
+        return self.latency
+
+    def allow(self, region):
+        """ Check the limits of the region and count the request """
+        with self.lock:
+            now = time.monotonic()
+            requests = self.requests.setdefault(region, deque())
+            longest = max(seconds for count, seconds in self.limits)
+            while requests and requests[0] <= now - longest:
+                requests.popleft()
+            for count, seconds in self.limits:
+                recent = sum(1 for t in requests if t > now - seconds)
+                if recent >= count:
+                    return False
+            requests.append(now)
+            return True
+
+    def first_match_id(self, region):
+        """ The first match id of the range of a region """
+        if self.shared_ids:
+            return 0
+        with self.lock:
+            return self.first_match_ids.setdefault(
+                region, len(self.first_match_ids) * 10 ** 8)
+
+    def count(self, status):
+        with self.lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def should_fail(self):
+        with self.lock:
+            self.served += 1
+            return self.fail_every is not None and \
+                self.served % self.fail_every == 0
+
+    def document(self, region, path, query):
+        """ The document for a request path """
+        if path.endswith("/league/challenger"):
+            return {"entries": [
+                {"playerOrTeamId": str(summoner), "leaguePoints": summoner}
+                for summoner in range(self.summoners)]}
+        last = int(path.rsplit("/", 1)[-1])
+        if "/matchlist/" in path:
+            begin_time = int(query.get("beginTime", [0])[0])
+            first = self.first_match_id(region)
+            matches = [
+                {"matchId": first + last * 10000 + match,
+                 "timestamp": self.start + match * 1000}
+                for match in range(self.matches_per_summoner)]
+            matches = [match for match in matches
+                       if match["timestamp"] >= begin_time]
+            with self.lock:
+                self.matchlist_entries += len(matches)
+            return {"matches": matches}
+        if self.match_document is not None:
+            return self.match_document(region, last)
+        return {"matchId": last, "region": region.upper()}
+
+    def body(self, region, path, query, compress):
+        """ The encoded document for a request path """
+        if "/match/" in path and (path, compress) in self.bodies:
+            return self.bodies[path, compress]
+        body = json.dumps(self.document(region, path, query)).encode()
+        if compress:
+            body = gzip.compress(body, compresslevel=6)
+        if "/match/" in path:
+            self.bodies[path, compress] = body
+        return body
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRiotHandler(BaseHTTPRequestHandler):
+    # Keeps the connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        # Paths look like /api/lol/{region}/...
+        region = path.split("/")[3]
+        if not self.server.allow(region):
+            self.server.count(429)
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        time.sleep(self.server.region_latency(region))
+        if self.server.should_fail():
+            self.server.count(503)
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        compress = "gzip" in self.headers.get("Accept-Encoding", "")
+        body = self.server.body(region, path, parse_qs(query), compress)
+        if self.server.bandwidth is not None:
+            time.sleep(len(body) / self.server.bandwidth)
+        self.server.count(200)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def use_stub_server(server, concurrency, limits):
+    """ Point the api at the stub server with a dummy api key, so that no
+        api_key file is needed. The settings and the session are restored
+        afterwards """
+    import riot_api
+    from lazy import Lazy
+
+    conf = riot_api.get_config()
+    settings = {
+        "api_key": "stub", "api_url": server.url,
+        "concurrency": concurrency, "rate_limits": limits, "limiters": {},
+        "cache": None}
+    saved = {name: getattr(conf, name) for name in settings}
+    for name, value in settings.items():
+        setattr(conf, name, value)
+    riot_api.riot_api = Lazy(riot_api.create_session)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(conf, name, value)
+        riot_api.riot_api = Lazy(riot_api.create_session)
+
+
+def bench_download(count, concurrency, limit, latency):
+    """ Download matches from a stub server that allows limit requests
+        per second and report the throughput """
+    import riot_api
+
+    limits = [(limit, 1), (limit * 60, 600)]
+    with StubRiotServer(limits, latency) as server, \
+            use_stub_server(server, concurrency, limits):
+        matches, seconds = timed(riot_api.get_matches, range(count))
+
+    if sorted(match["matchId"] for match in matches) != list(range(count)):
+        raise Exception("Not every match was downloaded")
+
+    print()
+    print("Downloaded {0} matches in {1:.2f} s".format(count, seconds))
+    print("Throughput: {0:.1f} requests/s (limit {1}/s)".format(
+        count / seconds, limit))
+    print("Responses by status: {0}".format(server.status_counts))
+
+
+def bench_http(count, concurrency, latency, fail_every, bandwidth):
+    """ Download count full synthetic matches from a stub server that
+        answers every fail_every request with a 503 and sends bandwidth
+        megabytes per second over each connection, without and with
+        compression. Reports the time, the bytes transferred and the
+        connections opened to the server. The matches are encoded by a
+        first download that isn't timed """
+    import riot_api
+    from lazy import Lazy
+    from metrics import metrics
+    from synthetic import synthetic_match
+
+    limits = [(10000, 1), (600000, 600)]
+    conf = riot_api.get_config()
+    conf.retry_backoff = 0.01
+    with synthetic_static_data():
+        champion_ids, item_ids = catalog_ids()
+
+    def document(region, match_id):
+        return synthetic_match(
+            match_id, champion_ids, item_ids, full=True)
+
+    runs = {}
+    with StubRiotServer(limits, latency, match_document=document,
+                        fail_every=fail_every) as server:
+        for compression in (False, True):
+            conf.compression = compression
+            server.bandwidth = None
+            # A new session for the settings
+            with use_stub_server(server, concurrency, limits):
+                riot_api.get_matches(range(count))
+                server.bandwidth = bandwidth * 1024 * 1024
+                server.status_counts = {}
+                riot_api.riot_api = Lazy(riot_api.create_session)
+                metrics.reset()
+                matches, seconds = timed(riot_api.get_matches, range(count))
+                if sorted(match["matchId"] for match in matches) != \
+                        list(range(count)):
+                    raise Exception("Not every match was downloaded")
+                runs[compression] = (
+                    seconds, metrics.counters["api.transferred_bytes"],
+                    metrics.counters["api.retries"],
+                    dict(server.status_counts), riot_api.connection_stats())
+
+    print()
+    for compression, (seconds, transferred, retries, statuses,
+                      connections) in runs.items():
+        print("{0}: {1:.2f} s, {2:.1f} kB per match".format(
+            "gzip" if compression else "identity", seconds,
+            transferred / count / 1024))
+        print("  Responses by status: {0}, retried {1}".format(
+            statuses, retries))
+        for host, (opened, requests_made) in connections.items():
+            print("  {0}: {1} requests over {2} connections".format(
+                host, requests_made, opened))
+
+
+def bench_regions(regions, latencies, concurrency, limit):
+    """ Crawl each region alone and then all of the regions at the same
+        time from a stub server with a different latency for each region """
+    limits = [(limit, 1), (limit * 60, 600)]
+    latency = dict(zip(regions, latencies))
+    with scratch_database(), StubRiotServer(limits, latency) as server:
+        import data
+
+        def crawl(regions):
+            # Every crawl starts from an empty database
+            with data.engine.begin() as conn:
+                for table in data.Base.metadata.sorted_tables:
+                    conn.execute(table.delete())
+            with use_stub_server(server, concurrency, limits):
+                return timed(list, data.crawl(regions))
+
+        times = {}
+        counts = {}
+        for region in regions:
+            matches, times[region] = crawl([region])
+            counts[region] = len(matches)
+        matches, together = crawl(regions)
+    if len(matches) != sum(counts.values()):
+        raise Exception("Crawled {0} matches from every region at once, {1} "
+                        "one region at a time".format(
+                            len(matches), sum(counts.values())))
+
+    print()
+    for region in regions:
+        print("{0}: {1:.2f} s".format(region, times[region]))
+    print("One region at a time: {0:.2f} s".format(sum(times.values())))
+    print("All regions at once:  {0:.2f} s ({1} matches)".format(
+        together, len(matches)))
+
+
+def bench_discovery(count, candidates, summoners, new_games):
+    """ Crawl two regions of a stub server fully and then incrementally
+        after each summoner has played new_games more games, and time
+        looking up which of the candidate match ids are already in a
+        database of count matches. The regions have the same match ids for
+        different games, so each region's games have to be kept. The last
+        incremental crawl is run with a pending item of another region
+        left in the work queue, which must not stop the crawled regions
+        from finding their new games """
+    limits = [(1000, 1), (60000, 600)]
+    regions = ["euw", "kr"]
+    with scratch_database():
+        import data
+        from sqlalchemy.sql import select
+        from synthetic import synthetic_match
+
+        champion_ids, item_ids = catalog_ids()
+        def document(region, match_id):
+            return dict(synthetic_match(
+                match_id, champion_ids, item_ids,
+                created_on=int(time.time() * 1000)), region=region.upper())
+
+        with StubRiotServer(limits, 0.001, summoners,
+                            match_document=document,
+                            shared_ids=True) as server, \
+                use_stub_server(server, 8, limits):
+            runs = []
+            for incremental in (False, True, True):
+                if len(runs) == 2:
+                    with data.engine.begin() as conn:
+                        data.enqueue(conn, "na", "summoner", ["stale"])
+                server.matchlist_entries = 0
+                seconds = timed(
+                    data.update_database, regions=regions,
+                    incremental=incremental)[1]
+                runs.append((server.matchlist_entries, seconds))
+                server.matches_per_summoner += new_games
+        with data.engine.connect() as conn:
+            stored = conn.execute("SELECT COUNT(*) FROM matches").scalar()
+            stale = conn.execute(
+                select([data.WorkItem.status]).
+                where(data.WorkItem.region == "na")).fetchall()
+        expected = len(regions) * summoners * (
+            server.matches_per_summoner - new_games)
+
+        # Only the match ids matter for the lookup, the other tables are
+        # left empty to keep the setup fast
+        with data.engine.begin() as conn:
+            conn.execute(data.Match.__table__.insert(), [
+                {"match_id": match_id, "region": "EUW", "version": ""}
+                for match_id in range(10 ** 9, 10 ** 9 + count)])
+        # Half of the ids are in the database
+        match_ids = set(range(
+            10 ** 9 + count - candidates // 2,
+            10 ** 9 + count + candidates // 2))
+
+        def whole_table():
+            with data.engine.connect() as conn:
+                known = {row[0] for row in conn.execute(
+                    select([data.Match.match_id]).
+                    where(data.Match.region == "EUW"))}
+            return match_ids - known
+
+        whole, whole_time = timed(whole_table)
+        batched, batched_time = timed(
+            data.get_match_ids_not_in_db, match_ids, "euw")
+
+    if stored != expected:
+        raise Exception("{0} matches in the database, expected {1}".format(
+            stored, expected))
+    if stale != [(data.PENDING,)]:
+        raise Exception("The queue of a region that wasn't crawled was "
+                        "changed: {0}".format(stale))
+    if whole != batched:
+        raise Exception("The batched lookup found different match ids")
+    print()
+    for name, (entries, seconds) in zip(
+            ("Full", "Incremental", "Stale queue"), runs):
+        print("{0} crawl: {1} matchlist entries in {2:.2f} s".format(
+            name, entries, seconds))
+    print("Reading every match id:      {0:.4f} s".format(whole_time))
+    print("Batched primary key lookups: {0:.4f} s".format(batched_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--synthetic-static", action="store_true",
+        help="Use synthetic versions, champion and item data instead of "
+             "the api")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    http_parser = subparsers.add_parser(
+        "http",
+        help="Download full matches from a stub server that fails some of "
+             "the requests, without and with compression")
+    http_parser.add_argument("--count", type=int, default=200)
+    http_parser.add_argument("--concurrency", type=int, default=8)
+    http_parser.add_argument("--latency", type=float, default=0.01)
+    http_parser.add_argument(
+        "--fail-every", type=int, default=10,
+        help="Answer every nth request with a 503")
+    http_parser.add_argument(
+        "--bandwidth", type=float, default=2,
+        help="Megabytes per second sent over each connection")
+
+    decay_parser = subparsers.add_parser(
+        "decay",
+        help="Check the time decayed counts against weighting every match")
+    decay_parser.add_argument("count", type=int)
+    decay_parser.add_argument("--days", type=int, default=14)
+    decay_parser.add_argument("--half-life", type=float, default=3)
+    decay_parser.add_argument("--patch-decay", type=float, default=0.5)
+
+    retention_parser = subparsers.add_parser(
+        "retention",
+        help="Expire and archive the old bought items and compact the "
+        "database")
+    retention_parser.add_argument("count", type=int)
+    retention_parser.add_argument("--days", type=int, default=42)
+    retention_parser.add_argument("--retain-days", type=int, default=14)
+
+    item_sets_parser = subparsers.add_parser(
+        "item_sets",
+        help="Compare building item sets one at a time and all at once")
+    item_sets_parser.add_argument("variants", type=int)
+    item_sets_parser.add_argument(
+        "--rank", choices=["popularity", "win_rate"], default="popularity")
+
+    stages_parser = subparsers.add_parser(
+        "stages",
+        help="Time each stage of making the item sets from synthetic "
+             "matches, without an api key")
+    stages_parser.add_argument(
+        "--count", type=int, default=1000,
+        help="Matches, from 100 to 100000")
+    stages_parser.add_argument("--days", type=int, default=7)
+    stages_parser.add_argument("--chunk-size", type=int, default=500)
+    stages_parser.add_argument(
+        "--output", help="File to save the results to as json")
+    stages_parser.add_argument(
+        "--compare", help="Results of an earlier run to compare to")
+
+    analyze_parser = subparsers.add_parser(
+        "analyze",
+        help="Per champion analysis against the batch analyzer")
+    analyze_parser.add_argument("days", type=int)
+
+    download_parser = subparsers.add_parser(
+        "download",
+        help="Match download throughput against a rate limited stub server")
+    download_parser.add_argument("--count", type=int, default=200)
+    download_parser.add_argument("--concurrency", type=int, default=8)
+    download_parser.add_argument(
+        "--limit", type=int, default=50, help="Requests allowed per second")
+    download_parser.add_argument(
+        "--latency", type=float, default=0.05,
+        help="Seconds the stub server takes to answer")
+
+    load_parser = subparsers.add_parser(
+        "load", help="Load synthetic matches to an empty database")
+    load_parser.add_argument("--count", type=int, default=10000)
+    load_parser.add_argument("--batch-size", type=int, default=100)
+
+    plans_parser = subparsers.add_parser(
+        "plans",
+        help="Check that the analyzer queries don't do full table scans")
+    plans_parser.add_argument("--count", type=int, default=1000)
+
+    workers_parser = subparsers.add_parser(
+        "workers",
+        help="Item set zip file creation with different amounts of workers")
+    workers_parser.add_argument("days", type=int)
+    workers_parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+
+    rollups_parser = subparsers.add_parser(
+        "rollups",
+        help="Analysis time from the raw rows and the rollups as the "
+             "history grows")
+    rollups_parser.add_argument(
+        "--count", type=int, default=1000, help="Matches per day")
+    rollups_parser.add_argument(
+        "--steps", type=int, default=7, help="Days of history")
+
+    imports_parser = subparsers.add_parser(
+        "imports",
+        help="Import time of the project modules without network access")
+    imports_parser.add_argument("module", nargs="?", default="generate")
+
+    categorize_parser = subparsers.add_parser(
+        "categorize",
+        help="Categorizing bought items with the item index")
+    categorize_parser.add_argument("--count", type=int, default=100)
+
+    regions_parser = subparsers.add_parser(
+        "regions",
+        help="Crawling regions one at a time and at the same time from a "
+             "stub server")
+    regions_parser.add_argument(
+        "--regions", nargs="+", default=["euw", "na", "kr"])
+    regions_parser.add_argument(
+        "--latencies", nargs="+", type=float, default=[0.02, 0.05, 0.1],
+        help="Seconds the stub server takes to answer for each region")
+    regions_parser.add_argument("--concurrency", type=int, default=4)
+    regions_parser.add_argument(
+        "--limit", type=int, default=50, help="Requests allowed per second")
+
+    discovery_parser = subparsers.add_parser(
+        "discovery",
+        help="Full and incremental crawls of a stub server and looking up "
+             "known match ids")
+    discovery_parser.add_argument(
+        "--count", type=int, default=1000000,
+        help="Matches in the database for the lookup")
+    discovery_parser.add_argument(
+        "--candidates", type=int, default=2000,
+        help="Match ids to look up")
+    discovery_parser.add_argument("--summoners", type=int, default=50)
+    discovery_parser.add_argument(
+        "--new-games", type=int, default=2,
+        help="Games each summoner plays between the crawls")
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot",
+        help="Analysis from a column snapshot against the database")
+    snapshot_parser.add_argument("--count", type=int, default=5000)
+
+    parse_parser = subparsers.add_parser(
+        "parse",
+        help="Parsing match responses with and without pruning the timeline")
+    parse_parser.add_argument(
+        "--fixtures",
+        help="Directory of recorded match responses, synthetic matches are "
+             "used without one")
+    parse_parser.add_argument("--count", type=int, default=50)
+
+    orders_parser = subparsers.add_parser(
+        "orders",
+        help="Mining build orders in one pass against per champion")
+    orders_parser.add_argument("--count", type=int, default=2000)
+
+    outcomes_parser = subparsers.add_parser(
+        "outcomes",
+        help="Check that the win rates add less than 10% to the item count "
+             "query")
+    outcomes_parser.add_argument(
+        "--count", type=int, default=MIN_OUTCOMES_COUNT)
+    outcomes_parser.add_argument("--repeat", type=int, default=15)
+
+    positions_parser = subparsers.add_parser(
+        "positions",
+        help="Counting items by champion and position in one pass")
+    positions_parser.add_argument("--count", type=int, default=2000)
+
+    args = parser.parse_args()
+    with synthetic_static_data() if args.synthetic_static else \
+            nullcontext():
+        if args.benchmark == "stages":
+            bench_stages(
+                args.count, args.days, args.chunk_size, args.output,
+                args.compare)
+        elif args.benchmark == "http":
+            bench_http(
+                args.count, args.concurrency, args.latency, args.fail_every,
+                args.bandwidth)
+        elif args.benchmark == "decay":
+            bench_decay(
+                args.count, args.days, args.half_life, args.patch_decay)
+        elif args.benchmark == "retention":
+            bench_retention(args.count, args.days, args.retain_days)
+        elif args.benchmark == "item_sets":
+            bench_item_sets(args.variants, args.rank)
+        elif args.benchmark == "analyze":
+            bench_analyze(args.days)
+        elif args.benchmark == "download":
+            bench_download(
+                args.count, args.concurrency, args.limit, args.latency)
+        elif args.benchmark == "categorize":
+            bench_categorize(args.count)
+        elif args.benchmark == "regions":
+            bench_regions(
+                args.regions, args.latencies, args.concurrency, args.limit)
+        elif args.benchmark == "discovery":
+            bench_discovery(
+                args.count, args.candidates, args.summoners, args.new_games)
+        elif args.benchmark == "snapshot":
+            bench_snapshot(args.count)
+        elif args.benchmark == "parse":
+            bench_parse(args.fixtures, args.count)
+        elif args.benchmark == "orders":
+            bench_build_orders(args.count)
+        elif args.benchmark == "outcomes":
+            if args.count < MIN_OUTCOMES_COUNT:
+                parser.error("outcomes needs at least {0} matches".format(
+                    MIN_OUTCOMES_COUNT))
+            if args.repeat < MIN_OUTCOMES_REPEAT:
+                parser.error("outcomes needs at least {0} rounds".format(
+                    MIN_OUTCOMES_REPEAT))
+            bench_outcomes(args.count, args.repeat)
+        elif args.benchmark == "positions":
+            bench_positions(args.count)
+        elif args.benchmark == "load":
+            bench_load(args.count, args.batch_size)
+        elif args.benchmark == "workers":
+            bench_workers(args.days, args.workers)
+        elif args.benchmark == "rollups":
+            bench_rollups(args.count, args.steps)
+        elif args.benchmark == "imports":
+            bench_imports(args.module)
+        elif args.benchmark == "plans":
+            check_query_plans(args.count)
+        else:
+            parser.print_help()
@@ -0,0 +1,94 @@
+""" Compressed on disk cache for the json documents from the api """
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+
+class ResponseCache:
+    """ Cache of json documents grouped by their kind, for example the
+        match documents or the static data of a patch. Each document is
+        stored compressed in a file named by the hash of its name.
+
+        The modification time of a file is the time it was stored and
+        is used for the ttl, the access time is updated on every read
+        and the least recently used documents are removed once the cache
+        grows over max_size bytes """
+
+    def __init__(self, directory='cache', max_size=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_size = max_size
+        self.__size = None
+        self.__lock = threading.Lock()
+
+    def path(self, kind, name):
+        digest = hashlib.sha1(str(name).encode()).hexdigest()
+        return os.path.join(self.directory, kind, digest)
+
+    def get(self, kind, name, ttl=None):
+        """ Get a document from the cache, returns None if the document
+            isn't cached or it was stored more than ttl seconds ago """
+        path = self.path(kind, name)
+        try:
+            stored = os.path.getmtime(path)
+            if ttl is not None and time.time() - stored > ttl:
+                return None
+            with open(path, 'rb') as f:
+                document = json.loads(zlib.decompress(f.read()).decode())
+            os.utime(path, (time.time(), stored))
+        except (OSError, ValueError, zlib.error):
+            return None
+        return document
+
+    def put(self, kind, name, document):
+        """ Store a document in the cache """
+        path = self.path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = zlib.compress(json.dumps(document).encode())
+        temporary = "{0}.{1}.tmp".format(path, threading.get_ident())
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+        with self.__lock:
+            if self.__size is None:
+                self.__size = sum(size for path, size, used in self.entries())
+            else:
+                self.__size += len(data)
+            if self.__size > self.max_size:
+                self.evict()
+
+    def documents(self, kind):
+        """ Yield every document of a kind that is in the cache """
+        directory = os.path.join(self.directory, kind)
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                continue
+            with open(os.path.join(directory, name), 'rb') as f:
+                yield json.loads(zlib.decompress(f.read()).decode())
+
+    def entries(self):
+        """ List (path, size, last used) of every file in the cache """
+        entries = []
+        for root, directories, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((path, stat.st_size, stat.st_atime))
+        return entries
+
+    def evict(self):
+        """ Remove the least recently used documents until the cache
+            is a tenth under max_size """
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, used in entries:
+            if size <= self.max_size * 0.9:
+                break
+            os.remove(path)
+            size -= entry_size
+        self.__size = size
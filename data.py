@@ -1,31 +1,91 @@
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Interval, ForeignKey)
+    create_engine, event, inspect, Column, Integer, BigInteger, String,
+    Boolean, Date, DateTime, Float, Interval, ForeignKeyConstraint, Index,
+    MetaData, Table)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.sql import select
+from sqlalchemy.sql import (
+    select, func, case, and_, or_, not_, exists, tuple_, bindparam,
+    literal_column, text)
+from queue import Queue
+from threading import Thread
 from datetime import datetime, timedelta
+from lazy import Lazy
+from metrics import metrics
 import riot_api
 import pickle
 import os
+import time
 
-# Set up sqlite3 with sqlalchemy
-engine = create_engine('sqlite:///data.db')
+# Set up sqlite3 with sqlalchemy, the path of the database file can be
+# changed with the CB_DATABASE environment variable
+database_file = os.environ.get('CB_DATABASE', 'data.db')
+engine = create_engine('sqlite:///' + database_file)
 Base = declarative_base()
 Session = sessionmaker()
 Session.configure(bind=engine)
+# Connections of processes that only read the data are made read only
+read_only = False
 
-# Get champion data from the api
-champions = riot_api.get_champions()
-# Get item data from the api
-items = riot_api.get_items()
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ Tune sqlite for loading lots of rows at once """
+    cursor = dbapi_connection.cursor()
+    # Only takes effect in new databases, compact() turns it on in the
+    # existing ones
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Negative cache size is in kibibytes
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    context.query_start = time.perf_counter()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    """ Time every statement, the rows of a select are fetched after this
+        so the time of reading them is in the timers of the callers """
+    metrics.record(
+        "sql.executemany" if executemany else "sql.execute",
+        time.perf_counter() - context.query_start)
+
+
+def open_read_only():
+    """ Make this process use its own read only connections, for worker
+        processes that share the database with their parent """
+    global read_only
+    read_only = True
+    engine.dispose()
+
+# Items bought before this (in milliseconds) count as starting items
+STARTING_ITEMS_TIME = 110 * 1000
+
+# Champion data from the api, downloaded on first use
+champions = Lazy(riot_api.get_champions)
+# Item data from the api, downloaded on first use
+items = Lazy(riot_api.get_items)
 
 
 class Match(Base):
-    """ Schema for Matches """
+    """ Schema for Matches, match ids are only unique within a region """
     __tablename__ = 'matches'
+    __table_args__ = (
+        Index('ix_matches_created_on_version', 'created_on', 'version'),
+    )
 
     match_id = Column(Integer, primary_key=True)
-    region = Column(String)
+    region = Column(String, primary_key=True)
     created_on = Column(DateTime)
     duration = Column(Interval)
     version = Column(String, index=True)
@@ -40,27 +100,47 @@ class Match(Base):
 class Champion(Base):
     """ Schema for Champions played in the matches """
     __tablename__ = 'champions'
+    __table_args__ = (
+        # Covers looking up the games of a champion, their outcomes and
+        # positions
+        Index('ix_champions_champion_key_covering',
+              'champion_key', 'match_id', 'region', 'participant_id',
+              'winner', 'role', 'lane'),
+        ForeignKeyConstraint(
+            ['match_id', 'region'], ['matches.match_id', 'matches.region']),
+    )
 
     id = Column(Integer, primary_key=True)
-    match_id = Column(Integer, ForeignKey('matches.match_id'), index=True)
+    match_id = Column(Integer, index=True)
+    region = Column(String)
     participant_id = Column(Integer)
     champion_key = Column(String)
     role = Column(String)
     lane = Column(String)
+    # Null for the games that were loaded before outcomes were stored
+    winner = Column(Boolean)
 
     def __repr__(self):
         s = "<id={0}, match_id={1}, participant_id={2}, champion_key={3},\
-role={4}, lane={5}>"
+role={4}, lane={5}, winner={6}>"
         return s.format(self.id, self.match_id, self.participant_id,
-                        self.champion_key, self.role, self.lane)
+                        self.champion_key, self.role, self.lane, self.winner)
 
 
 class BoughtItems(Base):
     """ Schema for all the items that have been bought in the matches """
     __tablename__ = 'bought_items'
+    __table_args__ = (
+        # Covers joining the items bought by a participant
+        Index('ix_bought_items_participant',
+              'match_id', 'region', 'participant_id', 'timestamp', 'item_id'),
+        ForeignKeyConstraint(
+            ['match_id', 'region'], ['matches.match_id', 'matches.region']),
+    )
 
     id = Column(Integer, primary_key=True)
-    match_id = Column(Integer, ForeignKey('matches.match_id'), index=True)
+    match_id = Column(Integer, index=True)
+    region = Column(String)
     item_id = Column(Integer)
     participant_id = Column(Integer)
     timestamp = Column(Integer)
@@ -72,58 +152,568 @@ timestamp={4}>"
                         self.participant_id, self.timestamp)
 
 
-def match_loader(matches):
-    """ Function for loading matches that have been
-        downloaded from the api to the database """
-    matches = [match for match in matches if "matchId" in match]
-    session = Session()
+def same_match(table, other):
+    """ Join condition of the rows of two tables that are from the same
+        match, the match id and the region together identify a match """
+    return and_(table.match_id == other.match_id,
+                table.region == other.region)
+
+
+# Positions of the participants, NONE when the lane and the role don't
+# tell the position
+POSITIONS = ["TOP", "JUNGLE", "MID", "ADC", "SUPPORT"]
+
+
+def position_of(role, lane):
+    """ Get the position of a participant from the role and the lane """
+    if role == "DUO_SUPPORT":
+        return "SUPPORT"
+    if role == "DUO_CARRY":
+        return "ADC"
+    if lane == "TOP":
+        return "TOP"
+    if lane == "JUNGLE":
+        return "JUNGLE"
+    if lane in ("MID", "MIDDLE"):
+        return "MID"
+    if lane in ("BOT", "BOTTOM"):
+        return "ADC"
+    return "NONE"
+
+
+# The position of a participant in sql, the same as position_of
+champion_position = case([
+    (Champion.role == "DUO_SUPPORT", "SUPPORT"),
+    (Champion.role == "DUO_CARRY", "ADC"),
+    (Champion.lane == "TOP", "TOP"),
+    (Champion.lane == "JUNGLE", "JUNGLE"),
+    (Champion.lane.in_(["MID", "MIDDLE"]), "MID"),
+    (Champion.lane.in_(["BOT", "BOTTOM"]), "ADC")], else_="NONE")
+
+
+class GameRollup(Base):
+    """ Schema for the amount of games played by each champion per day,
+        kept up to date when matches are loaded. decided is the amount of
+        the games with a known outcome """
+    __tablename__ = 'game_rollups'
+
+    day = Column(Date, primary_key=True)
+    version = Column(String, primary_key=True)
+    region = Column(String, primary_key=True)
+    champion_key = Column(String, primary_key=True)
+    position = Column(String, primary_key=True)
+    games = Column(Integer)
+    wins = Column(Integer)
+    decided = Column(Integer)
+
+
+class ItemRollup(Base):
+    """ Schema for the amount of times each item has been bought by each
+        champion per day, kept up to date when matches are loaded.
+        late is 0 for starting items and 1 for the items bought later.
+        wins and decided count the purchases in won games and in games
+        with a known outcome """
+    __tablename__ = 'item_rollups'
+
+    day = Column(Date, primary_key=True)
+    version = Column(String, primary_key=True)
+    region = Column(String, primary_key=True)
+    champion_key = Column(String, primary_key=True)
+    position = Column(String, primary_key=True)
+    late = Column(Integer, primary_key=True)
+    item_id = Column(Integer, primary_key=True)
+    count = Column(Integer)
+    wins = Column(Integer)
+    decided = Column(Integer)
+
+
+class SummonerWatermark(Base):
+    """ Schema for the timestamp of the latest game that has been seen in
+        the matchlist of each summoner, later crawls only ask for newer
+        games """
+    __tablename__ = 'summoner_watermarks'
+
+    region = Column(String, primary_key=True)
+    summoner_id = Column(String, primary_key=True)
+    last_seen = Column(BigInteger)
+
+
+# Statuses of the items in the work queue, downloaded matches are done once
+# they have been loaded to the database
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkItem(Base):
+    """ Schema for the work queue of a crawl, the summoners whose match
+        lists are asked for and the matches that are downloaded. The queue
+        is kept until every item in it is done or failed, so that an
+        interrupted crawl can resume where it stopped """
+    __tablename__ = 'work_queue'
+    __table_args__ = (
+        Index('ix_work_queue_status',
+              'kind', 'region', 'status', 'next_attempt'),
+    )
+
+    # "summoner" or "match"
+    kind = Column(String, primary_key=True)
+    region = Column(String, primary_key=True)
+    item_id = Column(String, primary_key=True)
+    status = Column(String)
+    attempts = Column(Integer)
+    last_error = Column(String)
+    # Unix time after which the item can be tried again
+    next_attempt = Column(Float)
+
+
+def match_rows(match):
+    """ Parse a match that has been downloaded from the api to rows for
+        the matches, champions and bought_items tables """
+    match_row = {
+        "match_id": match["matchId"],
+        "region": match["region"],
+        "created_on": datetime.utcfromtimestamp(
+            int(match["matchCreation"] / 1000)),
+        "duration": timedelta(seconds=match["matchDuration"]),
+        "version": match["matchVersion"]
+    }
+    participants = []
+    for participant in match["participants"]:
+        participants.append({
+            "match_id": match["matchId"],
+            "region": match["region"],
+            "participant_id": participant["participantId"],
+            "champion_key": champion_key_from_id(
+                participant["championId"]),
+            "role": participant["timeline"]["role"],
+            "lane": participant["timeline"]["lane"],
+            "winner": participant.get("stats", {}).get("winner"),
+        })
+    items_bought = []
+    for item in get_items_bought(match):
+        items_bought.append({
+            'item_id': item["itemId"],
+            'match_id': match["matchId"],
+            'region': match["region"],
+            'participant_id': item["participantId"],
+            'timestamp': item["timestamp"]
+        })
+    return match_row, participants, items_bought
+
+
+def rows_loader(rows):
+    """ Load rows that have been parsed with match_rows to the database.
+        All the tables are written with executemany in one transaction """
     new_matches = []
     new_participants = []
     items_bought = []
 
+    for match_row, participants, items in rows:
+        new_matches.append(match_row)
+        new_participants.extend(participants)
+        items_bought.extend(items)
+
+    if not new_matches:
+        return
+    with metrics.timer("db.load"):
+        games, item_counts = rollup_counts(
+            new_matches, new_participants, items_bought)
+        with engine.begin() as conn:
+            conn.execute(Match.__table__.insert(), new_matches)
+            if new_participants:
+                conn.execute(Champion.__table__.insert(), new_participants)
+            if items_bought:
+                conn.execute(BoughtItems.__table__.insert(), items_bought)
+            add_to_rollup(conn, GameRollup.__table__, games)
+            add_to_rollup(conn, ItemRollup.__table__, item_counts)
+            loaded = {}
+            for match_row in new_matches:
+                loaded.setdefault(match_row["region"].lower(), []).append(
+                    match_row["match_id"])
+            for region, match_ids in loaded.items():
+                finish_items(conn, region, "match", match_ids)
+    metrics.count("db.matches", len(new_matches))
+    metrics.count("db.bought_items", len(items_bought))
+
+
+def rollup_counts(new_matches, new_participants, items_bought):
+    """ Count the games and the bought items in the rows by the keys of
+        the GameRollup and ItemRollup tables. The counts are lists of the
+        amount, the wins and the games with a known outcome """
+    matches = {
+        (match["region"], match["match_id"]): (
+            match["created_on"].date(), match["version"], match["region"])
+        for match in new_matches
+    }
+    champions = {}
+    games = {}
+    for participant in new_participants:
+        day, version, region = matches[
+            participant["region"], participant["match_id"]]
+        key = participant["champion_key"]
+        position = position_of(participant["role"], participant["lane"])
+        outcome = outcome_counts(participant["winner"])
+        champions[participant["region"], participant["match_id"],
+                  participant["participant_id"]] = (key, position, outcome)
+        add_counts(games, (day, version, region, key, position), outcome)
+
+    item_counts = {}
+    for item in items_bought:
+        champion = champions.get(
+            (item["region"], item["match_id"], item["participant_id"]))
+        if champion is None or item["timestamp"] == STARTING_ITEMS_TIME:
+            continue
+        key, position, outcome = champion
+        day, version, region = matches[item["region"], item["match_id"]]
+        late = 0 if item["timestamp"] < STARTING_ITEMS_TIME else 1
+        add_counts(
+            item_counts,
+            (day, version, region, key, position, late, item["item_id"]),
+            outcome)
+
+    return games, item_counts
+
+
+def outcome_counts(winner):
+    """ The amount, wins and decided counts of one game """
+    if winner is None:
+        return (1, 0, 0)
+    return (1, int(winner), 1)
+
+
+def add_counts(counts, key, values):
+    if key not in counts:
+        counts[key] = [0] * len(values)
+    for index, value in enumerate(values):
+        counts[key][index] += value
+
+
+def add_to_rollup(conn, table, counts):
+    """ Add the counts keyed by the primary key of the table to the
+        columns after the key, a key that isn't in the table yet is
+        inserted with the counts. Needs SQLite 3.24 for the upsert """
+    if not counts:
+        return
+    keys = [key.name for key in table.primary_key.columns]
+    columns = [column.name for column in table.columns
+               if not column.primary_key]
+    upsert = text(
+        "INSERT INTO {table} ({names}) VALUES ({values}) "
+        "ON CONFLICT ({keys}) DO UPDATE SET {counts}".format(
+            table=table.name,
+            names=", ".join(keys + columns),
+            values=", ".join(":" + name for name in keys + columns),
+            keys=", ".join(keys),
+            counts=", ".join(
+                "{0} = {0} + excluded.{0}".format(column)
+                for column in columns))).\
+        bindparams(*[bindparam(name, type_=table.c[name].type)
+                     for name in keys + columns])
+    conn.execute(upsert, [
+        dict(zip(keys + columns, key + tuple(values)))
+        for key, values in counts.items()])
+
+
+def rollup_queries():
+    """ Queries that count the rollups from the raw rows """
+    day = func.date(Match.created_on, type_=Date)
+    wins = func.coalesce(func.sum(Champion.winner, type_=Integer), 0)
+    decided = func.count(Champion.winner)
+    games = select([
+        day, Match.version, Match.region, Champion.champion_key,
+        champion_position, func.count(Champion.id), wins, decided]).\
+        select_from(Champion.__table__.join(
+            Match, same_match(Champion, Match))).\
+        group_by(day, Match.version, Match.region, Champion.champion_key,
+                 champion_position)
+
+    late = case([(BoughtItems.timestamp < STARTING_ITEMS_TIME, 0)], else_=1)
+    item_counts = select([
+        day, Match.version, Match.region, Champion.champion_key,
+        champion_position, late, BoughtItems.item_id,
+        func.count(BoughtItems.item_id), wins, decided]).\
+        select_from(
+            Champion.__table__.join(
+                BoughtItems,
+                onclause=same_match(Champion, BoughtItems)).join(
+                Match)).\
+        where(Champion.participant_id == BoughtItems.participant_id).\
+        where(BoughtItems.timestamp != STARTING_ITEMS_TIME).\
+        group_by(day, Match.version, Match.region, Champion.champion_key,
+                 champion_position, late, BoughtItems.item_id)
+
+    return {GameRollup.__table__: games, ItemRollup.__table__: item_counts}
+
+
+def rebuild_rollups():
+    """ Count the rollup tables again from the raw rows """
+    with engine.begin() as conn:
+        for table, query in rollup_queries().items():
+            conn.execute(table.delete())
+            conn.execute(table.insert().from_select(
+                [column.name for column in table.columns], query))
+
+
+def check_rollups():
+    """ Compare the rollup tables to the counts from the raw rows.
+        Returns a dict of the differing rows keyed by the table name
+        with (stored counts, expected counts) tuples keyed by the key """
+    differences = {}
+    with engine.connect() as conn:
+        for table, query in rollup_queries().items():
+            keys = len(table.primary_key.columns)
+            expected = {
+                tuple(row[:keys]): tuple(row[keys:])
+                for row in conn.execute(query)
+            }
+            stored = {
+                tuple(row[:keys]): tuple(row[keys:])
+                for row in conn.execute(select(list(table.columns)))
+                if row[keys] != 0
+            }
+            differing = {
+                key: (stored.get(key), expected.get(key))
+                for key in set(stored) | set(expected)
+                if stored.get(key) != expected.get(key)
+            }
+            if differing:
+                differences[table.name] = differing
+    return differences
+
+
+def match_loader(matches):
+    """ Function for loading matches that have been
+        downloaded from the api to the database """
+    with metrics.timer("db.parse"):
+        rows = [match_rows(match) for match in matches if "matchId" in match]
+    rows_loader(rows)
+
+
+def stream_loader(matches, batch_size=100):
+    """ Load matches to the database while they are being downloaded.
+        Each match is parsed as soon as it arrives and the rows are
+        committed every batch_size matches so that only one batch is
+        kept in memory and an interrupted run keeps the loaded batches """
+    batch = []
     for match in matches:
-        new_matches.append(Match(
-            match_id=match["matchId"],
-            region=match["region"],
-            created_on=datetime.utcfromtimestamp(
-                int(match["matchCreation"] / 1000)),
-            duration=timedelta(seconds=match["matchDuration"]),
-            version=match["matchVersion"]
-        ))
-        for participant in match["participants"]:
-            new_participants.append({
-                "match_id": match["matchId"],
-                "participant_id": participant["participantId"],
-                "champion_key": champion_key_from_id(
-                    participant["championId"]),
-                "role": participant["timeline"]["role"],
-                "lane": participant["timeline"]["lane"],
-            })
-        for item in get_items_bought(match):
-            items_bought.append({
-                'item_id': item["itemId"],
-                'match_id': match["matchId"],
-                'participant_id': item["participantId"],
-                'timestamp': item["timestamp"]
-            })
-
-    session.add_all(new_matches)
-    session.commit()
-    conn = engine.connect()
-    conn.execute(Champion.__table__.insert(), new_participants)
-    conn.execute(BoughtItems.__table__.insert(), items_bought)
-    conn.close()
-
-
-def get_match_ids_not_in_db(match_ids):
-    """ Compares the list of matchIds given as a argument
-        and returns the set are NOT already in the db """
-    q = select([Match.match_id])
+        if "matchId" in match:
+            with metrics.timer("db.parse"):
+                batch.append(match_rows(match))
+        if len(batch) >= batch_size:
+            rows_loader(batch)
+            batch = []
+    if batch:
+        rows_loader(batch)
+
+
+def get_match_ids_not_in_db(match_ids, region, batch_size=500):
+    """ Compares the list of matchIds of a region given as a argument
+        and returns the set are NOT already in the db. The ids are looked
+        up from the primary key in batches instead of reading every match
+        id in the database """
+    match_ids = set(match_ids)
+    ordered = sorted(match_ids)
+    known = set()
+    q = select([Match.match_id]).\
+        where(Match.match_id.in_(bindparam("match_ids", expanding=True))).\
+        where(Match.region == region.upper())
+    with engine.connect() as conn:
+        for start in range(0, len(ordered), batch_size):
+            batch = ordered[start:start + batch_size]
+            known.update(row[0] for row in conn.execute(q, match_ids=batch))
+
+    return match_ids - known
+
+
+def get_watermarks(region):
+    """ Get the timestamps of the latest games seen from the summoners of
+        a region, keyed by the summoner id """
+    q = select([SummonerWatermark.summoner_id, SummonerWatermark.last_seen]).\
+        where(SummonerWatermark.region == region)
     with engine.connect() as conn:
-        result = conn.execute(q).fetchall()
-        result = set([match_id[0] for match_id in result])
+        return dict(conn.execute(q).fetchall())
+
+
+def save_watermarks(conn, region, watermarks):
+    """ Store the timestamps of the latest games seen from the summoners
+        of a region """
+    if not watermarks:
+        return
+    conn.execute(
+        SummonerWatermark.__table__.insert().prefix_with("OR REPLACE"), [
+            {"region": region, "summoner_id": summoner_id,
+             "last_seen": last_seen}
+            for summoner_id, last_seen in watermarks.items()])
+
+
+# Attempts at an item of the work queue before it is failed for good, the
+# item is tried again QUEUE_BACKOFF * 2 ** (attempts - 1) seconds after
+# each failed attempt
+QUEUE_ATTEMPTS = 5
+QUEUE_BACKOFF = 1
+
+
+def open_queue(regions):
+    """ Prepare the work queue of the regions for a crawl, each region on
+        its own and the queues of the other regions are left as they are.
+        Returns the regions whose interrupted crawl is resumed, their
+        downloaded matches that weren't loaded are downloaded again. The
+        queue of the last crawl of the other regions is emptied except for
+        the matches that were failed, they are tried again with fresh
+        attempts. The watermarks of their summoners are already past them,
+        so they wouldn't be found again """
+    queue = WorkItem.__table__
+    failed_matches = (queue.c.kind == "match") & (queue.c.status == FAILED)
+    resumed = []
+    with engine.begin() as conn:
+        for region in regions:
+            in_region = queue.c.region == region
+            unfinished = conn.execute(select([func.count()]).where(
+                in_region &
+                queue.c.status.in_([PENDING, DOWNLOADED]))).scalar()
+            if unfinished:
+                resumed.append(region)
+                conn.execute(queue.update().
+                             where(in_region &
+                                   (queue.c.status == DOWNLOADED)).
+                             values(status=PENDING))
+            else:
+                conn.execute(queue.delete().
+                             where(in_region & ~failed_matches))
+                conn.execute(queue.update().
+                             where(in_region & failed_matches).
+                             values(status=PENDING, attempts=0,
+                                    next_attempt=0))
+    return resumed
+
+
+def enqueue(conn, region, kind, item_ids):
+    """ Add pending items to the work queue, items that are already in it
+        are left as they are """
+    if not item_ids:
+        return
+    conn.execute(WorkItem.__table__.insert().prefix_with("OR IGNORE"), [
+        {"kind": kind, "region": region, "item_id": str(item_id),
+         "status": PENDING, "attempts": 0, "next_attempt": 0}
+        for item_id in item_ids])
 
-    return match_ids - result
+
+def enqueue_matches(conn, region, match_ids):
+    """ Add the matches of a region that aren't in the database to the
+        work queue """
+    enqueue(conn, region, "match",
+            sorted(get_match_ids_not_in_db(match_ids, region)))
+
+
+def is_queued(region, kind):
+    """ Whether the work queue has any items of a kind in a region """
+    q = select([WorkItem.item_id]).\
+        where(WorkItem.kind == kind).\
+        where(WorkItem.region == region).\
+        limit(1)
+    with engine.connect() as conn:
+        return conn.execute(q).first() is not None
+
+
+def due_items(region, kind):
+    """ Get the ids of the pending items of a kind that can be tried now,
+        in the order they were queued """
+    q = select([WorkItem.item_id]).\
+        where(WorkItem.kind == kind).\
+        where(WorkItem.region == region).\
+        where(WorkItem.status == PENDING).\
+        where(WorkItem.next_attempt <= time.time()).\
+        order_by(literal_column("rowid"))
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(q)]
+
+
+def next_attempt_in(region, kind):
+    """ Seconds until the next pending item of a kind can be tried, None
+        if there are no pending items """
+    q = select([func.min(WorkItem.next_attempt)]).\
+        where(WorkItem.kind == kind).\
+        where(WorkItem.region == region).\
+        where(WorkItem.status == PENDING)
+    with engine.connect() as conn:
+        next_attempt = conn.execute(q).scalar()
+    if next_attempt is None:
+        return None
+    return max(0, next_attempt - time.time())
+
+
+def finish_items(conn, region, kind, item_ids, status=DONE, batch_size=500):
+    """ Set the status of items of a kind in the work queue of a region """
+    queue = WorkItem.__table__
+    q = queue.update().\
+        where(queue.c.kind == kind).\
+        where(queue.c.region == region).\
+        where(queue.c.item_id.in_(bindparam("item_ids", expanding=True))).\
+        values(status=status)
+    item_ids = [str(item_id) for item_id in item_ids]
+    for start in range(0, len(item_ids), batch_size):
+        conn.execute(q, item_ids=item_ids[start:start + batch_size])
+
+
+def fail_item(region, kind, item_id, error):
+    """ Count a failed attempt at an item, it is tried again after a
+        backoff or failed for good after QUEUE_ATTEMPTS attempts """
+    queue = WorkItem.__table__
+    key = (queue.c.kind == kind) & (queue.c.region == region) & \
+        (queue.c.item_id == str(item_id))
+    with engine.begin() as conn:
+        attempts = conn.execute(
+            select([queue.c.attempts]).where(key)).scalar() + 1
+        conn.execute(queue.update().where(key).values(
+            attempts=attempts,
+            last_error="{0}: {1}".format(type(error).__name__, error),
+            status=FAILED if attempts >= QUEUE_ATTEMPTS else PENDING,
+            next_attempt=time.time() + QUEUE_BACKOFF * 2 ** (attempts - 1)))
+    metrics.count("queue.failed_attempts")
+
+
+def failed_items(regions):
+    """ Get the items of the regions that were failed for good as (kind,
+        region, item id, last error) tuples """
+    q = select([WorkItem.kind, WorkItem.region, WorkItem.item_id,
+                WorkItem.last_error]).\
+        where(WorkItem.status == FAILED).\
+        where(WorkItem.region.in_(regions))
+    with engine.connect() as conn:
+        return conn.execute(q).fetchall()
+
+
+def attempt(function, argument):
+    """ Call the function and return the argument, the result and the
+        exception the call raised, if any, instead of raising it """
+    try:
+        return argument, function(argument), None
+    except Exception as e:
+        return argument, None, e
+
+
+def work_through(region, kind, function, done, progress_string):
+    """ Call the function with the id of each pending item of a kind using
+        conf.concurrency threads and done with the id and the result. Items
+        that raise are tried again after their backoff while the other
+        items go on, until every item is done or failed """
+    while True:
+        item_ids = due_items(region, kind)
+        if not item_ids:
+            wait = next_attempt_in(region, kind)
+            if wait is None:
+                return
+            time.sleep(wait)
+            continue
+        for item_id, result, error in riot_api.iter_download(
+                lambda item_id: attempt(function, item_id), item_ids,
+                progress_string):
+            if error is None:
+                done(item_id, result)
+            else:
+                fail_item(region, kind, item_id, error)
 
 
 def champion_keys():
@@ -134,19 +724,29 @@ def champion_keys():
     return sorted(keys)
 
 
+def patch_of(version):
+    """ The season and the major version of a version, "6.13" of "6.13.1.1" """
+    return ".".join(version.split(".")[:2])
+
+
+def current_patches():
+    """ Get the patches of the versions from the api, newest first """
+    patches = []
+    for version in riot_api.get_versions():
+        if patch_of(version) not in patches:
+            patches.append(patch_of(version))
+    return patches
+
+
 def get_items_bought(match):
     """ Get items that have been purchased in a game """
     if "timeline" not in match:
         return []
-    frames = match["timeline"]["frames"]
-    events_lists = [
-        frame['events'] for frame in frames if "events" in frame
-    ]
-    events = [
-        event for lists in events_lists for event in lists
+    return [
+        event for frame in match["timeline"]["frames"]
+        for event in frame.get("events", ())
         if event["eventType"] == "ITEM_PURCHASED"
     ]
-    return events
 
 
 def champion_key_from_id(champion_id):
@@ -160,8 +760,9 @@ def item_name_from_id(item_id):
 
 
 def is_final_item(item_id):
-    """ Check if the item given is final """
-    return "into" not in items["data"][str(item_id)]
+    """ Check if the item given is final, items that aren't in the item
+        data of the current patch aren't """
+    return bool(item_categories.get(int(item_id), 0) & FINAL)
 
 
 class ItemTags:
@@ -197,29 +798,390 @@ class ItemTags:
         return s
 
 
-def update_database(days=1):
-    """ Updates the database with the latest games """
-    if not os.path.isfile('data.db'):
+# Bit flags of the item categories
+OFFENSIVE = 1
+DEFENSIVE = 2
+CONSUMABLE = 4
+# Set for items that don't build into anything
+FINAL = 8
+
+
+def categorize_items(items):
+    """ Classify every item of the item data once.
+        Returns a dict of category bit flags keyed by the item id """
+    categories = {}
+    for item in items["data"].values():
+        flags = 0 if "into" in item else FINAL
+        tags = set(item.get("tags", []))
+        if not ItemTags.offensive.isdisjoint(tags):
+            flags |= OFFENSIVE
+        if not ItemTags.defensive.isdisjoint(tags):
+            flags |= DEFENSIVE
+        if not ItemTags.consumable.isdisjoint(tags):
+            flags |= CONSUMABLE
+        categories[item["id"]] = flags
+    return categories
+
+# Categories of the items of the current patch, shared by all analyzers
+item_categories = Lazy(lambda: categorize_items(items))
+
+
+# Version of the rollup tables, stored as the user_version of the database.
+# Rollups of an older version are counted again from the raw rows
+ROLLUP_VERSION = 3
+
+
+def keys_changed(inspector, table):
+    """ Whether the primary key or the foreign keys of a table in the
+        database differ from the declared ones """
+    primary_key = inspector.get_pk_constraint(table.name)[
+        "constrained_columns"]
+    foreign_keys = sorted(
+        (key["constrained_columns"], key["referred_table"],
+         key["referred_columns"])
+        for key in inspector.get_foreign_keys(table.name))
+    declared = sorted(
+        ([element.parent.name for element in key.elements],
+         key.referred_table.name,
+         [element.column.name for element in key.elements])
+        for key in table.foreign_key_constraints)
+    return primary_key != [column.name for column in
+                           table.primary_key.columns] or \
+        foreign_keys != declared
+
+
+def rebuild_table(conn, table):
+    """ Create a table again with its declared schema and copy its rows to
+        it, for the changes sqlite can't alter like the primary key """
+    old = table.name + "_old"
+    for index in inspect(conn).get_indexes(table.name):
+        conn.execute("DROP INDEX {0}".format(index["name"]))
+    conn.execute("ALTER TABLE {0} RENAME TO {1}".format(table.name, old))
+    table.create(conn)
+    columns = ", ".join(column.name for column in table.columns)
+    conn.execute("INSERT INTO {0} ({1}) SELECT {1} FROM {2}".format(
+        table.name, columns, old))
+    conn.execute("DROP TABLE {0}".format(old))
+
+
+def migrate():
+    """ Bring an existing database up to date by creating the tables,
+        columns and indexes that are missing from it, creating the tables
+        with changed keys and the indexes with changed columns again and
+        dropping the indexes that are no longer declared """
+    rollup_tables = [GameRollup.__table__, ItemRollup.__table__]
+    with engine.connect() as conn:
+        version = conn.execute("PRAGMA user_version").scalar()
+    outdated = version < ROLLUP_VERSION or not all(
+        engine.has_table(table.name) for table in rollup_tables)
+    if outdated:
+        for table in rollup_tables:
+            table.drop(engine, checkfirst=True)
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    added = set()
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(
+            table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                added.add((table.name, column.name))
+                with engine.connect() as conn:
+                    conn.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                        table.name, column.name,
+                        column.type.compile(engine.dialect)))
+    rebuilt = [table for table in Base.metadata.sorted_tables
+               if keys_changed(inspector, table)]
+    if rebuilt:
+        with engine.begin() as conn:
+            # The sqlite3 module only begins a transaction before changing
+            # rows, and the references of the other tables to a renamed
+            # table are kept as they are
+            conn.execute("BEGIN")
+            conn.execute("PRAGMA legacy_alter_table=ON")
+            for table in rebuilt:
+                rebuild_table(conn, table)
+            conn.execute("PRAGMA legacy_alter_table=OFF")
+    with engine.begin() as conn:
+        # The matches were keyed by the match id alone before the region
+        # was stored with the champions and the bought items
+        for table in (Champion.__table__, BoughtItems.__table__):
+            if (table.name, "region") not in added:
+                continue
+            conn.execute(table.update().
+                         where(table.c.region.is_(None)).
+                         values(region=select([Match.region]).
+                                where(Match.match_id == table.c.match_id).
+                                limit(1).as_scalar()))
+    if outdated:
+        rebuild_rollups()
+        with engine.connect() as conn:
+            conn.execute("PRAGMA user_version = {0}".format(ROLLUP_VERSION))
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"]: index["column_names"]
+                    for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            columns = [column.name for column in index.columns]
+            if existing.get(index.name, columns) != columns:
+                with engine.connect() as conn:
+                    conn.execute("DROP INDEX {0}".format(index.name))
+                del existing[index.name]
+            if index.name not in existing:
+                index.create(engine)
+        declared = {index.name for index in table.indexes}
+        for name in set(existing) - declared:
+            if name.startswith("ix_"):
+                with engine.connect() as conn:
+                    conn.execute("DROP INDEX {0}".format(name))
+
+
+def crawl_region(region, days, matches, watermarks=None):
+    """ Download the latest games of a region to the matches queue through
+        the work queue. The challenger summoners are queued, the match ids
+        of their match lists are queued once each summoner is done and the
+        queued matches are downloaded. Match ids are only unique within a
+        region, so the matches of each region are queued and looked up by
+        the region. With watermarks only the games after the latest game
+        seen from each summoner are asked for, the watermarks are stored
+        with the match ids of the summoner """
+    if not is_queued(region, "summoner"):
+        with engine.begin() as conn:
+            enqueue(conn, region, "summoner",
+                    riot_api.get_challenger_summoner_ids(region))
+    begin_time = riot_api.get_begin_time(days)
+    end_time = int(time.time()) * 1000
+
+    def matchlist(summoner_id):
+        if watermarks and summoner_id in watermarks:
+            summoner_begin_time = max(begin_time, watermarks[summoner_id] + 1)
+        else:
+            summoner_begin_time = begin_time
+        return riot_api.get_matches_from_summoner(
+            summoner_id, days, region, summoner_begin_time, end_time)
+
+    def summoner_done(summoner_id, matchlist):
+        timestamps = [match["timestamp"] for match in matchlist
+                      if "timestamp" in match]
+        with engine.begin() as conn:
+            enqueue_matches(
+                conn, region, [match["matchId"] for match in matchlist])
+            if timestamps:
+                save_watermarks(conn, region, {summoner_id: max(
+                    timestamps + [(watermarks or {}).get(summoner_id, 0)])})
+            finish_items(conn, region, "summoner", [summoner_id])
+
+    def match_done(match_id, match):
+        if "matchId" not in match:
+            fail_item(region, "match", match_id,
+                      riot_api.ApiError("No match in the response"))
+            return
+        with engine.begin() as conn:
+            finish_items(conn, region, "match", [match_id], DOWNLOADED)
+        matches.put(match)
+
+    work_through(
+        region, "summoner", matchlist, summoner_done,
+        region.upper() + ": Retrieving matches from summoner {0} out of {1}")
+    # Matches that were loaded before an interruption are done already
+    with engine.begin() as conn:
+        pending = due_items(region, "match")
+        finish_items(conn, region, "match", set(pending) - {
+            str(match_id) for match_id in get_match_ids_not_in_db(
+                (int(match_id) for match_id in pending), region)})
+    work_through(
+        region, "match", lambda match_id: riot_api.get_match(
+            int(match_id), region), match_done,
+        region.upper() + ": Retrieving match {0} out {1}")
+
+
+def crawl(regions, days=1, watermarks=None):
+    """ Crawl the latest games of the regions at the same time, each
+        region in its own thread within its own rate limits. Yields the
+        matches as they are downloaded. watermarks is a dict of the
+        watermarks of each region for crawling only the new games """
+    matches = Queue(maxsize=riot_api.conf.concurrency * 2 * len(regions))
+    done = object()
+
+    def crawler(region):
+        try:
+            crawl_region(
+                region, days, matches,
+                None if watermarks is None else watermarks[region])
+            matches.put(done)
+        except Exception as e:
+            matches.put(e)
+
+    for region in regions:
+        Thread(target=crawler, args=(region,), daemon=True).start()
+    running = len(regions)
+    while running:
+        match = matches.get()
+        if match is done:
+            running -= 1
+        elif isinstance(match, Exception):
+            raise match
+        else:
+            yield match
+
+
+def update_database(days=1, batch_size=100, regions=None, incremental=False):
+    """ Updates the database with the latest games. Incremental updates
+        only ask for the games each summoner has played since the last
+        update. The summoners and matches to download are kept in a work
+        queue in the database, so an interrupted update resumes from the
+        items that weren't done yet and items that keep failing are given
+        up on without stopping the update """
+    if not os.path.isfile(database_file):
         create_db_from_scratch()
-    challenger_ids = riot_api.get_challenger_summoner_ids()
-    match_ids = riot_api.get_match_ids_from_challenger(
-        challenger_ids, days=days)
-    match_ids = get_match_ids_not_in_db(match_ids)
-    matches = riot_api.get_matches(match_ids)
-    match_loader(matches)
+    migrate()
+    if regions is None:
+        regions = riot_api.conf.regions
+    resumed = open_queue(regions)
+    if resumed:
+        print("Resuming the unfinished update of {0}".format(
+            ", ".join(resumed)))
+    watermarks = {region: get_watermarks(region) if incremental else {}
+                  for region in regions}
+    stream_loader(crawl(regions, days, watermarks), batch_size)
+    failed = failed_items(regions)
+    if failed:
+        print("Gave up on {0} items after {1} attempts:".format(
+            len(failed), QUEUE_ATTEMPTS))
+        for kind, region, item_id, last_error in failed:
+            print("  {0} {1} {2}: {3}".format(
+                region, kind, item_id, last_error))
 
 
-def create_db_from_cache():
-    """ Create the database from a pickled set of matches """
-    with open('matches.cache', 'rb') as f:
-        matches = pickle.load(f)
+# The bought items of the expired matches are archived to a database file
+# per week of the matches, the week is formatted like "2016-W27"
+ARCHIVE_FILE = "bought_items-{0}.db"
+archived_items = Table(
+    "bought_items", MetaData(),
+    *[Column(column.name, column.type, primary_key=column.primary_key)
+      for column in BoughtItems.__table__.columns],
+    schema="archive")
+Index("ix_archive_bought_items_match_id", archived_items.c.match_id)
+
+
+def expired(days=None, patches=None):
+    """ Condition for the matches that are older than the days or from a
+        patch more than patches behind the current patch """
+    conditions = []
+    if days is not None:
+        conditions.append(
+            Match.created_on < datetime.utcnow() - timedelta(days=days))
+    if patches is not None:
+        conditions.append(not_(or_(*[
+            Match.version.like(patch + ".%")
+            for patch in current_patches()[:patches]])))
+    return or_(*conditions)
 
+
+def expire_bought_items(days=None, patches=None, archive=None):
+    """ Remove the bought items of the matches that are older than the days
+        or from a patch more than patches behind the current patch, so the
+        size of the database and the time of the queries stay bounded. The
+        items are counted in the rollups when they are loaded and the
+        matches and the champions are kept, so the rollups and the game
+        counts keep the whole history. With an archive directory the items
+        are moved to a database file per week of the matches in it,
+        otherwise they are dropped. Returns the amount of removed items.
+
+        The rollups of the removed items can't be counted again from the
+        raw rows, rebuild_rollups() leaves them out """
+    if days is None and patches is None:
+        return 0
+    condition = expired(days, patches)
+    week = func.strftime("%Y-W%W", Match.created_on)
+    removed = 0
+    with engine.connect() as conn:
+        weeks = [row[0] for row in conn.execute(
+            select([week]).distinct().
+            where(condition).
+            where(exists().where(same_match(BoughtItems, Match))).
+            order_by(week))]
+        for name in weeks:
+            matches = tuple_(BoughtItems.match_id, BoughtItems.region).in_(
+                select([Match.match_id, Match.region]).
+                where(condition).
+                where(week == name))
+            with metrics.timer("retention.expire"):
+                if archive is not None:
+                    os.makedirs(archive, exist_ok=True)
+                    conn.execute("ATTACH DATABASE ? AS archive", (
+                        os.path.join(archive, ARCHIVE_FILE.format(name)),))
+                try:
+                    with conn.begin():
+                        if archive is not None:
+                            archived_items.create(conn, checkfirst=True)
+                            conn.execute(
+                                archived_items.insert().
+                                prefix_with("OR IGNORE").
+                                from_select(
+                                    [c.name for c in archived_items.columns],
+                                    BoughtItems.__table__.select().
+                                    where(matches)))
+                        count = conn.execute(
+                            BoughtItems.__table__.delete().where(matches)).\
+                            rowcount
+                finally:
+                    if archive is not None:
+                        conn.execute("DETACH DATABASE archive")
+            removed += count
+            metrics.count(
+                "retention.archived_items" if archive is not None
+                else "retention.dropped_items", count)
+    return removed
+
+
+def compact():
+    """ Give the pages that removed rows left free back to the file system.
+        Databases made before incremental vacuuming are vacuumed fully
+        once to turn it on, after that only the free pages are released.
+        Returns the size of the database file before and after """
+    before = os.path.getsize(database_file)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        with metrics.timer("retention.vacuum"):
+            if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                cursor.execute("VACUUM")
+            else:
+                # The sqlite3 module steps the pragma only once, which
+                # frees a single page, so it is repeated for every page
+                free = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+                cursor.execute("BEGIN")
+                for _ in range(free):
+                    cursor.execute("PRAGMA incremental_vacuum(1)")
+                cursor.execute("COMMIT")
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        cursor.close()
+    finally:
+        connection.close()
+    return before, os.path.getsize(database_file)
+
+
+def create_db_from_cache():
+    """ Create the database from a pickled set of matches if there is one,
+        otherwise from the matches in the response cache """
     Base.metadata.create_all(engine)
-    match_loader(matches)
+    if os.path.isfile('matches.cache'):
+        with open('matches.cache', 'rb') as f:
+            matches = pickle.load(f)
+        match_loader(matches)
+    elif riot_api.conf.cache is not None:
+        stream_loader(riot_api.conf.cache.documents("match"))
 
 
 def create_db_from_scratch():
     """ Creates the database from scratch """
-    if os.path.isfile('data.db'):
-        os.remove('data.db')
+    engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        path = database_file + suffix
+        if os.path.isfile(path):
+            os.remove(path)
     Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        conn.execute("PRAGMA user_version = {0}".format(ROLLUP_VERSION))
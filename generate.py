@@ -1,14 +1,18 @@
 from datetime import datetime
-from analyze import BuildAnalyzer
-from item_set import ItemSetBuilder
-import zipfile
-from data import champion_keys, update_database, create_db_from_scratch
-import json
+from item_set import create_zipfile, RANKINGS
+from data import (
+    update_database, create_db_from_scratch, migrate, expire_bought_items,
+    compact)
 import argparse
-from shutil import copytree, rmtree
-from os import mkdir
-from os.path import isdir
-from riot_api import get_config
+import filecmp
+import os
+from shutil import copy2
+from riot_api import get_config, count_connections, PRODUCTION_RATE_LIMITS
+from lazy import Lazy
+from analyze import PATCH_DECAY
+from metrics import metrics
+import cProfile
+import pstats
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -33,49 +37,194 @@ parser.add_argument(
     otherwise you are going to hit rate limits",
     action="store_true"
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--concurrency",
+    help="The amount of api requests to keep in flight at the same time",
+    type=int,
+    default=get_config().concurrency
+)
+parser.add_argument(
+    "--workers",
+    help="The amount of processes used for building the item sets",
+    type=int,
+    default=1
+)
+parser.add_argument(
+    "--rollups",
+    help="Analyze the daily counts that are kept while loading the games \
+    instead of every bought item, the days are counted as whole days",
+    action="store_true"
+)
+parser.add_argument(
+    "--regions",
+    help="The regions to download the games from, the regions are crawled \
+    at the same time",
+    nargs="+",
+    default=get_config().regions
+)
+parser.add_argument(
+    "--incremental",
+    help="Only download the games each summoner has played since the last \
+    update",
+    action="store_true"
+)
+parser.add_argument(
+    "--rank",
+    help="Order the items by how often they are bought or by their win \
+    rate, the win rate is smoothed towards the champion's win rate and the \
+    lower end of its confidence interval is used so that rarely bought \
+    items don't jump to the top",
+    choices=list(RANKINGS),
+    default="popularity"
+)
+parser.add_argument(
+    "--positions",
+    help="Also make an item set for each position a champion is played in \
+    often enough",
+    action="store_true"
+)
+parser.add_argument(
+    "--analyze-regions",
+    help="Only use the games from this region for the item sets, give it \
+    once for each region to use",
+    action="append"
+)
+parser.add_argument(
+    "--half-life",
+    help="Weight the games by their age instead of counting every game of \
+    the days equally, the weight of a game halves every this many days. \
+    Uses the daily counts like --rollups",
+    type=float
+)
+parser.add_argument(
+    "--patch-decay",
+    help="With --half-life, the factor the weight of a game is multiplied \
+    by for every patch it is behind the current patch",
+    type=float,
+    default=PATCH_DECAY
+)
+parser.add_argument(
+    "--retain-days",
+    help="Remove the bought items of the games older than this many days \
+    from the database once they are counted in the daily counts, has to be \
+    at least the days analyzed",
+    type=int
+)
+parser.add_argument(
+    "--retain-patches",
+    help="Remove the bought items of the games from more than this many \
+    patches behind the current patch",
+    type=int
+)
+parser.add_argument(
+    "--archive",
+    help="Move the removed bought items to a database file per week in \
+    this directory instead of dropping them"
+)
+parser.add_argument(
+    "--profile",
+    help="Profile the run with cProfile, the stats are saved to the \
+    --profile-output file and the slowest functions are printed",
+    action="store_true"
+)
+parser.add_argument(
+    "--profile-output",
+    help="The file the stats of --profile are saved to",
+    default="generate.prof"
+)
+
+
+def read_template():
+    with open('templates/index.html', 'r') as f:
+        return f.read()
 
-with open('templates/index.html', 'r') as f:
-    template = f.read()
+template = Lazy(read_template)
 
 
 def copy_static(path):
-    copytree("templates/static/", path + "static/")
+    """ Copy the static files to the target directory. Only the files that
+        changed are copied and the files that are no longer in the
+        templates are removed """
+    source = "templates/static/"
+    target = path + "static/"
+    copied = set()
+    for directory, _, files in os.walk(source):
+        target_directory = os.path.join(
+            target, os.path.relpath(directory, source))
+        os.makedirs(target_directory, exist_ok=True)
+        for name in files:
+            target_file = os.path.join(target_directory, name)
+            copied.add(os.path.normpath(target_file))
+            if not os.path.isfile(target_file) or not filecmp.cmp(
+                    os.path.join(directory, name), target_file,
+                    shallow=False):
+                copy2(os.path.join(directory, name), target_file)
+    for directory, _, files in os.walk(target):
+        for name in files:
+            if os.path.normpath(os.path.join(directory, name)) not in copied:
+                os.remove(os.path.join(directory, name))
 
 
-def create_index(path):
+def create_index(path, days):
     index = template.format(
         timestamp=datetime.utcnow(),
         filename="item_set.zip",
-        days=args.days)
+        days=days)
     with open(path, mode='w') as f:
         f.write(index)
 
 
-def create_zipfile(path):
-    zf = zipfile.ZipFile(
-        path, mode='w', compression=zipfile.ZIP_LZMA)
-    for key in champion_keys():
-        print("Building items for " + key)
-        fname = key + "/Recommended/" + key + ".json"
-        j = json.dumps(
-            ItemSetBuilder(BuildAnalyzer(key, args.days)).generate(),
-            indent=2)
-        zf.writestr(fname, j)
-    zf.close()
-
-if __name__ == "__main__":
+def main(args):
+    if args.no_download:
+        get_config().offline = True
     if args.production:
-        get_config().wait_time = 0.025
+        get_config().rate_limits = PRODUCTION_RATE_LIMITS
+    get_config().concurrency = args.concurrency
+    get_config().regions = args.regions
     if args.create_database:
         create_db_from_scratch()
     if not args.no_download:
-        update_database(days=args.days)
+        with metrics.timer("generate.download"):
+            update_database(
+                days=args.days, regions=args.regions,
+                incremental=args.incremental)
+    else:
+        migrate()
+    if args.retain_days is not None or args.retain_patches is not None:
+        with metrics.timer("generate.retention"):
+            removed = expire_bought_items(
+                args.retain_days, args.retain_patches, args.archive)
+            before, after = compact()
+        print("Removed {0} bought items, the database went from {1:.1f} MB \
+to {2:.1f} MB".format(removed, before / 1e6, after / 1e6))
     path = 'target/'
-    # Clear the target directory
-    if isdir(path):
-        rmtree(path)
-    mkdir(path)
+    # The target directory is kept between runs, the item sets that didn't
+    # change are copied from the last zip file
+    os.makedirs(path, exist_ok=True)
     copy_static(path)
-    create_index(path + 'index.html')
-    create_zipfile(path + 'item_set.zip')
+    create_index(path + 'index.html', args.days)
+    with metrics.timer("generate.item_sets"):
+        create_zipfile(
+            path + 'item_set.zip', args.days, args.workers, args.rollups,
+            args.analyze_regions, args.rank, args.positions, args.half_life,
+            args.patch_decay)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.retain_days is not None and args.retain_days < args.days:
+        parser.error("--retain-days can't be less than the days analyzed")
+    if args.retain_patches is not None and args.retain_patches < 1:
+        parser.error("--retain-patches has to keep at least one patch")
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.runcall(main, args)
+        profile.dump_stats(args.profile_output)
+    else:
+        main(args)
+    count_connections()
+    print()
+    print(metrics.report())
+    if args.profile:
+        print()
+        pstats.Stats(args.profile_output).sort_stats("cumulative").print_stats(25)
@@ -1,7 +1,19 @@
-from analyze import BuildAnalyzer
-from data import champion_keys
+from analyze import (
+    BuildAnalyzer, BatchAnalyzer, DecayAnalyzer, PATCH_DECAY)
+from data import (
+    champion_keys, open_read_only, POSITIONS,
+    item_categories, OFFENSIVE, DEFENSIVE, CONSUMABLE)
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import hashlib
 import json
+import os
+from operator import itemgetter
+import struct
+import zipfile
+import zlib
 from pathlib import Path
+from metrics import metrics, measured
 
 
 def rounded(num):
@@ -14,20 +26,33 @@ def rounded(num):
         return int(num)
 
 
+# Ways to order the items of the blocks, the first is the default
+RANKINGS = {
+    "popularity": itemgetter("percentage"),
+    "win_rate": itemgetter("low_win_rate"),
+}
+
+# Percentage of the games a starting item has to be bought in to make the
+# cut, and the same for the items of the other blocks
+STARTING_ITEM_PERCENTAGE = 50
+ITEM_PERCENTAGE = 3
+
+
 class ItemSetBuilder:
 
     __analyzer = None
 
-    def __init__(self, analyzer):
+    def __init__(self, analyzer, rank="popularity"):
         if type(analyzer) is BuildAnalyzer:
             self.__analyzer = analyzer
         else:
             raise Exception("Analyzer is not valid")
+        self.rank = RANKINGS[rank]
 
     def starting_items(self):
         items = []
         for item in self.__analyzer.starting_items:
-            if item["percentage"] > 50:
+            if item["percentage"] > STARTING_ITEM_PERCENTAGE:
                 items.append({
                     "id": str(item["item_id"]),
                     "count": rounded(item["avg_count"])
@@ -37,47 +62,120 @@ class ItemSetBuilder:
     def items(self, l):
         items = []
         for item in sorted(l,
-                           key=lambda x: x["percentage"],
+                           key=self.rank,
                            reverse=True):
-                if item["percentage"] > 3:
+                if item["percentage"] > ITEM_PERCENTAGE:
                     items.append({
                         "id": str(item["item_id"]),
                         "count": rounded(item["avg_count"])
                     })
         return items
 
+    def build_order(self):
+        return [{"id": str(item_id), "count": 1}
+                for item_id, count in self.__analyzer.build_order]
+
+    def generate(self):
+        return item_set(self.__analyzer, [
+            self.starting_items(),
+            self.build_order(),
+            self.items(self.__analyzer.offensive_items),
+            self.items(self.__analyzer.defensive_items),
+            self.items(self.__analyzer.other_items),
+            self.items(self.__analyzer.consumables)
+        ])
+
+
+# Types of the blocks of an item set, in order
+BLOCKS = [
+    "Starting items", "Core build order", "Offensive items",
+    "Defensive items", "Other items", "Consumables"]
+STARTING_BLOCK = BLOCKS.index("Starting items")
+BUILD_ORDER_BLOCK = BLOCKS.index("Core build order")
+OFFENSIVE_BLOCK = BLOCKS.index("Offensive items")
+DEFENSIVE_BLOCK = BLOCKS.index("Defensive items")
+OTHER_BLOCK = BLOCKS.index("Other items")
+CONSUMABLE_BLOCK = BLOCKS.index("Consumables")
+
+
+def item_set(analyzer, blocks):
+    """ The item set of an analyzer with the lists of items of the blocks """
+    return {
+        "title": "CB for {0} ({1:.0f} games)".format(
+            " ".join(filter(None, [analyzer.championKey, analyzer.position])),
+            analyzer.gameCount),
+        "type": "custom",
+        "map": "SR",
+        "mode": "CLASSIC",
+        "blocks": [{"type": block, "items": items}
+                   for block, items in zip(BLOCKS, blocks)]
+    }
+
+
+def item_blocks(item_id):
+    """ Indexes of the blocks an item goes to, an item can be both
+        offensive and defensive. Items that aren't in the item data of
+        the current patch have no categories """
+    categories = item_categories.get(item_id, 0)
+    blocks = []
+    if categories & OFFENSIVE:
+        blocks.append(OFFENSIVE_BLOCK)
+    if categories & DEFENSIVE:
+        blocks.append(DEFENSIVE_BLOCK)
+    if not categories & (OFFENSIVE | DEFENSIVE | CONSUMABLE):
+        blocks.append(OTHER_BLOCK)
+    if categories & CONSUMABLE:
+        blocks.append(CONSUMABLE_BLOCK)
+    return blocks
+
+
+class BatchItemSetBuilder:
+    """ Builds the item sets of many analyzers at once. The blocks of an
+        item id and the entry of an item id and a count are worked out
+        once for every analyzer, so each analyzer only filters and sorts
+        its items once and deals them to the blocks in one pass instead of
+        filtering and sorting each block. Gives the same item sets as an
+        ItemSetBuilder for each analyzer, the entries of the items are
+        shared between the item sets """
+
+    def __init__(self, analyzers, rank="popularity"):
+        self.analyzers = list(analyzers)
+        self.rank = RANKINGS[rank]
+
     def generate(self):
-        d = {
-            "title": "CB for {0} ({1} games)".format(
-                self.__analyzer.championKey,
-                self.__analyzer.gameCount),
-            "type": "custom",
-            "map": "SR",
-            "mode": "CLASSIC",
-            "blocks": [
-                {
-                    "type": "Starting items",
-                    "items": self.starting_items()
-                },
-                {
-                    "type": "Offensive items",
-                    "items": self.items(self.__analyzer.offensive_items)
-                },
-                {
-                    "type": "Defensive items",
-                    "items": self.items(self.__analyzer.defensive_items)
-                },
-                {
-                    "type": "Other items",
-                    "items": self.items(self.__analyzer.other_items)
-                },
-                {
-                    "type": "Consumables",
-                    "items": self.items(self.__analyzer.consumables)
-                }
-            ]
-        }
-        return d
+        """ Returns the item sets in the order of the analyzers """
+        blocks_of = {}
+        entries = {}
+
+        def entry(item):
+            key = (item["item_id"], rounded(item["avg_count"]))
+            if key not in entries:
+                entries[key] = {"id": str(key[0]), "count": key[1]}
+            return entries[key]
+
+        item_sets = []
+        for analyzer in self.analyzers:
+            blocks = [[] for block in BLOCKS]
+            blocks[STARTING_BLOCK] = [
+                entry(item) for item in analyzer.starting_items
+                if item["percentage"] > STARTING_ITEM_PERCENTAGE]
+            blocks[BUILD_ORDER_BLOCK] = [
+                {"id": str(item_id), "count": 1}
+                for item_id, count in analyzer.build_order]
+            # The sort is stable so ties keep the order of the analyzer's
+            # items like in the ItemSetBuilder
+            for item in sorted(
+                    [item for item in analyzer.items
+                     if item["percentage"] > ITEM_PERCENTAGE],
+                    key=self.rank, reverse=True):
+                item_id = item["item_id"]
+                if item_id not in blocks_of:
+                    blocks_of[item_id] = item_blocks(item_id)
+                item_entry = entry(item)
+                for block in blocks_of[item_id]:
+                    blocks[block].append(item_entry)
+            item_sets.append(item_set(analyzer, blocks))
+        return item_sets
 
 
 def create_directories():
@@ -96,3 +194,170 @@ def create_files():
                 ItemSetBuilder(BuildAnalyzer(key)).generate(),
                 f,
                 indent=2)
+
+
+def build_item_sets(keys, days, rollups=False, regions=None,
+                    rank="popularity", positions=False, half_life=None,
+                    patch_decay=PATCH_DECAY):
+    """ Build the item sets of the champions with the given keys. With
+        positions each position with enough games gets an item set too.
+        With a half_life the games are weighted by their age and patch.
+        Returns a list of (key, position, item set json) tuples, the
+        position is None for the item set of every position """
+    def analyzers(positions):
+        if half_life is None:
+            return BatchAnalyzer(
+                days, keys, rollups, regions, positions).analyzers()
+        return DecayAnalyzer(
+            days, keys, regions, positions, half_life,
+            patch_decay).analyzers()
+
+    by_champion = analyzers(False)
+    by_position = analyzers(True) if positions else {}
+    item_sets = []
+    for key in keys:
+        item_sets.append((key, None, by_champion[key]))
+        item_sets.extend(
+            (key, position, by_position[key, position])
+            for position in POSITIONS if (key, position) in by_position)
+    documents = BatchItemSetBuilder(
+        [analyzer for key, position, analyzer in item_sets], rank).generate()
+    return [(key, position, json.dumps(document, indent=2))
+            for (key, position, analyzer), document in zip(
+                item_sets, documents)]
+
+
+# Date of every member of the zip file, so that the same item sets always
+# give the same zip file no matter when or with how many workers they were
+# written. The earliest date a zip file can hold
+MEMBER_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class ItemSetArchive:
+    """ Zip file of item sets that is written next to the previous zip file
+        at the same path and replaces it when closed. The hash of each
+        item set is kept in a manifest next to the zip file, an item set
+        that has the same hash as in the previous zip file is copied from
+        it without compressing it again. The member is only copied if its
+        CRC matches the item set too, so a manifest that doesn't belong to
+        the zip file after a crash between replacing them isn't trusted """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.splitext(path)[0] + ".manifest.json"
+        self.previous = None
+        self.previous_members = {}
+        try:
+            with open(self.manifest_path) as f:
+                self.previous_members = json.load(f)["members"]
+            self.previous = zipfile.ZipFile(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            self.previous_members = {}
+        self.members = {}
+        self.zf = zipfile.ZipFile(
+            path + ".tmp", mode='w', compression=zipfile.ZIP_LZMA)
+
+    def write(self, key, name, j):
+        """ Write the json of an item set, or copy it from the previous zip
+            file if it hasn't changed """
+        fname = key + "/Recommended/" + name + ".json"
+        encoded = j.encode()
+        digest = hashlib.sha1(encoded).hexdigest()
+        self.members[fname] = {"sha1": digest}
+        previous = self.previous_members.get(fname)
+        if previous is not None and previous["sha1"] == digest:
+            try:
+                info = self.previous.getinfo(fname)
+            except KeyError:
+                info = None
+            if info is not None and info.CRC == zlib.crc32(encoded):
+                with metrics.timer("zip.copy"):
+                    copy_member(self.previous, self.zf, info)
+                metrics.count("zip.copied_entries")
+                return
+        info = zipfile.ZipInfo(fname, date_time=MEMBER_DATE_TIME)
+        info.compress_type = zipfile.ZIP_LZMA
+        info.external_attr = 0o644 << 16
+        with metrics.timer("zip.write"):
+            self.zf.writestr(info, j)
+        metrics.count("zip.entries")
+        metrics.count("zip.bytes", len(j))
+        metrics.count("zip.compressed_bytes",
+                      self.zf.getinfo(fname).compress_size)
+
+    def close(self):
+        """ Replace the previous zip file and its manifest """
+        self.zf.close()
+        if self.previous is not None:
+            self.previous.close()
+        os.replace(self.path + ".tmp", self.path)
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"members": self.members}, f, indent=2, sort_keys=True)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+
+# Size of the fixed part of the local file header of a zip member
+LOCAL_HEADER_SIZE = 30
+# Flag of a member whose sizes are in a data descriptor after its data
+DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def copy_member(source, target, info):
+    """ Copy the compressed data of a member of a zip file to a zip file
+        that is being written, without decompressing and compressing it """
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    source.fp.seek(
+        info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+    data = source.fp.read(info.compress_size)
+    copied = copy.copy(info)
+    copied.flag_bits &= ~DATA_DESCRIPTOR_FLAG
+    copied.header_offset = target.fp.tell()
+    target.fp.write(copied.FileHeader())
+    target.fp.write(data)
+    target.filelist.append(copied)
+    target.NameToInfo[copied.filename] = copied
+    target.start_dir = target.fp.tell()
+
+
+def write_item_sets(archive, item_sets):
+    """ Write (key, position, item set json) tuples to the archive """
+    for key, position, j in item_sets:
+        name = key if position is None else key + "_" + position
+        print("Building items for " + name)
+        archive.write(key, name, j)
+
+
+def create_zipfile(path, days, workers=1, rollups=False, regions=None,
+                   rank="popularity", positions=False, half_life=None,
+                   patch_decay=PATCH_DECAY):
+    """ Create a zip file of the item sets of every champion. With more
+        than one worker the champions are split between worker processes
+        and the item sets are written in the same order as with one. The
+        item sets that haven't changed since the last zip file at the path
+        are copied from it """
+    keys = champion_keys()
+    archive = ItemSetArchive(path)
+    if workers > 1:
+        chunk_size = -(-len(keys) // workers)
+        chunks = [keys[i:i + chunk_size]
+                  for i in range(0, len(keys), chunk_size)]
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=open_read_only) as executor:
+            results = executor.map(
+                measured, [build_item_sets] * len(chunks),
+                chunks, [days] * len(chunks),
+                [rollups] * len(chunks), [regions] * len(chunks),
+                [rank] * len(chunks), [positions] * len(chunks),
+                [half_life] * len(chunks), [patch_decay] * len(chunks))
+            for item_sets, exported in results:
+                # The timers of the workers are merged to ours
+                metrics.merge(exported)
+                write_item_sets(archive, item_sets)
+    else:
+        write_item_sets(
+            archive, build_item_sets(
+                keys, days, rollups, regions, rank, positions, half_life,
+                patch_decay))
+    archive.close()
@@ -0,0 +1,39 @@
+import threading
+
+
+class Lazy:
+    """ Accessor for a value that is only created when it is first used.
+        Initialize with a function that creates the value, attributes and
+        items of the accessor are looked up from the value """
+
+    def __init__(self, factory):
+        self.__factory = factory
+        self.__value = None
+        self.__loaded = False
+        self.__lock = threading.Lock()
+
+    def load(self):
+        """ Get the value, creating it if it hasn't been created yet """
+        if not self.__loaded:
+            with self.__lock:
+                if not self.__loaded:
+                    self.__value = self.__factory()
+                    self.__loaded = True
+        return self.__value
+
+    @property
+    def loaded(self):
+        """ Whether the value has been created """
+        return self.__loaded
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def __iter__(self):
+        return iter(self.load())
@@ -0,0 +1,104 @@
+""" Timers and counters for the stages of generating the item sets.
+    Time a block of code with:
+
+        with metrics.timer("zip.write"):
+            ...
+
+    and count things with metrics.count("api.bytes", len(content)). The
+    names are grouped into stages by the part before the first dot and
+    report() gives the totals and latencies of every timer and counter.
+    The durations of timers in concurrent threads are added up """
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import threading
+import time
+
+
+def percentile(durations, percent):
+    """ Nearest rank percentile of a sorted list of durations """
+    rank = max(0, -(-len(durations) * percent // 100) - 1)
+    return durations[int(rank)]
+
+
+class Metrics:
+    """ Timers and counters that are shared between threads. Every
+        duration of a timer is kept for the percentiles """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.durations = defaultdict(list)
+            self.counters = Counter()
+
+    def record(self, name, seconds):
+        """ Add a duration to a timer """
+        with self.__lock:
+            self.durations[name].append(seconds)
+
+    def count(self, name, amount=1):
+        """ Add to a counter """
+        with self.__lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def timer(self, name):
+        """ Time the block, it is recorded even if it raises """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def export(self):
+        """ The timers and counters as plain dicts, for sending them from
+            a worker process to be merged in the parent """
+        with self.__lock:
+            return dict(self.durations), dict(self.counters)
+
+    def merge(self, exported):
+        """ Add the timers and counters exported from another process """
+        durations, counters = exported
+        with self.__lock:
+            for name, values in durations.items():
+                self.durations[name].extend(values)
+            self.counters.update(counters)
+
+    def report(self):
+        """ The totals, calls and p50/p95 latencies of each timer and the
+            value of each counter grouped by stage """
+        durations, counters = self.export()
+        lines = []
+        if durations:
+            lines.append("{0:<32}{1:>8}{2:>12}{3:>11}{4:>11}".format(
+                "timer", "calls", "total s", "p50 ms", "p95 ms"))
+            totals = Counter()
+            for name in sorted(durations):
+                values = sorted(durations[name])
+                totals[name.split(".")[0]] += sum(values)
+                lines.append(
+                    "{0:<32}{1:>8}{2:>12.3f}{3:>11.2f}{4:>11.2f}".format(
+                        name, len(values), sum(values),
+                        percentile(values, 50) * 1000,
+                        percentile(values, 95) * 1000))
+            lines.append("")
+            lines.append("{0:<32}{1:>20}".format("stage", "total s"))
+            for stage in sorted(totals):
+                lines.append("{0:<32}{1:>20.3f}".format(stage, totals[stage]))
+        if counters:
+            lines.append("")
+            lines.append("{0:<32}{1:>20}".format("counter", "value"))
+            for name in sorted(counters):
+                lines.append("{0:<32}{1:>20}".format(name, counters[name]))
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+
+def measured(function, *args):
+    """ Call the function with fresh metrics and return its result with
+        the metrics it recorded, for functions run in worker processes """
+    metrics.reset()
+    return function(*args), metrics.export()
@@ -1,16 +1,116 @@
 import requests
+import json
+import random
 import time
+import threading
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
-
-
-endTime = int(time.time()) * 1000
+from cache import ResponseCache
+from lazy import Lazy
+from metrics import metrics
+
+
+# Rate limits as (requests, seconds) windows
+DEVELOPMENT_RATE_LIMITS = [(10, 10), (500, 600)]
+PRODUCTION_RATE_LIMITS = [(3000, 10), (180000, 600)]
+
+
+class ApiError(Exception):
+    """ A request that the api answered with an error or with a body that
+        can't be read """
+
+
+class RateLimiter:
+    """ Token bucket rate limiter that is shared between threads.
+        Initialize with a list of (requests, seconds) windows, each
+        window is a bucket of tokens and a request has to take a token
+        from every bucket. A spent token goes back to its bucket once
+        the window and a safety margin for the latency between us and
+        the server have passed so no window sees too many requests """
+
+    def __init__(self, limits, margin=0.1):
+        self.limits = limits
+        self.margin = margin
+        self.__spent = [deque() for limit in limits]
+        self.__paused_until = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a request can be made """
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                wait = self.__paused_until - now
+                for (count, seconds), spent in zip(self.limits, self.__spent):
+                    seconds += self.margin
+                    while spent and spent[0] <= now - seconds:
+                        spent.popleft()
+                    if len(spent) >= count:
+                        wait = max(wait, spent[0] + seconds - now)
+                if wait <= 0:
+                    for spent in self.__spent:
+                        spent.append(now)
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ Stop handing out tokens for the given amount of seconds """
+        with self.__lock:
+            self.__paused_until = max(
+                self.__paused_until, time.monotonic() + seconds)
 
 
 class Config:
-    API_KEY = open('api_key', 'r').readline().rstrip()
 
     def __init__(self):
-        self.wait_time = 1.3
+        self.api_key_file = 'api_key'
+        # The api key, read from api_key_file if None
+        self.api_key = None
+        self.api_url = 'https://{region}.api.pvp.net'
+        # Regions that are crawled for matches
+        self.regions = ['euw']
+        # How many requests are kept in flight at the same time per region
+        self.concurrency = 4
+        # Rate limits are per region, each region gets its own limiter
+        self.rate_limits = DEVELOPMENT_RATE_LIMITS
+        self.limiters = {}
+        self.__lock = threading.Lock()
+        # Cache for the api responses, None to not cache
+        self.cache = ResponseCache()
+        # How many seconds the list of versions is cached
+        self.versions_ttl = 60 * 60
+        # Use cached responses even if they are older than their ttl
+        self.offline = False
+        # Seconds to wait for the api to connect and to answer a request
+        self.timeout = 10
+        # Times a request that times out, fails to connect or gets a 5xx
+        # is tried again, after about retry_backoff * 2 ** (retry - 1)
+        # seconds
+        self.retries = 3
+        self.retry_backoff = 0.5
+        # Ask for gzip compressed responses
+        self.compression = True
+
+    @property
+    def API_KEY(self):
+        if self.api_key is not None:
+            return self.api_key
+        with open(self.api_key_file, 'r') as f:
+            return f.readline().rstrip()
+
+    def limiter(self, region):
+        """ Get the rate limiter of a region """
+        with self.__lock:
+            if region not in self.limiters:
+                self.limiters[region] = RateLimiter(self.rate_limits)
+            return self.limiters[region]
+
+    def url(self, region, path):
+        """ Get the url of an api path in a region """
+        return self.api_url.format(region=region) + \
+            path.format(region=region)
 
 conf = Config()
 
@@ -18,8 +118,25 @@ conf = Config()
 def get_config():
     return conf
 
-riot_api = requests.Session()
-riot_api.params.update({"api_key": conf.API_KEY})
+
+def create_session():
+    """ Create the session used for the api requests. The session keeps a
+        pool of connections to each host, a region is its own host and
+        every thread of a region gets a connection of its own that stays
+        open between the requests """
+    session = requests.Session()
+    session.params.update({"api_key": conf.API_KEY})
+    session.headers["Accept-Encoding"] = \
+        "gzip" if conf.compression else "identity"
+    adapter = requests.adapters.HTTPAdapter(
+        # The regions and the global host of the static data
+        pool_connections=max(10, len(conf.regions) + 1),
+        pool_maxsize=conf.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+riot_api = Lazy(create_session)
 
 
 class CurrentVersion:
@@ -28,10 +145,7 @@ class CurrentVersion:
     minor = None
 
     def __init__(self):
-        version = riot_api.get(
-            'https://global.api.pvp.net/api/lol/static-data/euw/v1.2/versions'
-        )
-        version = version.json()[0]
+        version = get_versions()[0]
         self.season, self.major, self.minor = version.split(".")
 
     def __str__(self):
@@ -42,6 +156,104 @@ class CurrentVersion:
         return "{}.{}%".format(self.season, self.major)
 
 
+def cached(kind, name, fetch, ttl=None):
+    """ Get a document from the response cache, or with fetch if it isn't
+        cached. Documents that fetch fails to get aren't cached. In
+        offline mode cached documents are used however old they are """
+    if conf.cache is not None:
+        document = conf.cache.get(kind, name, None if conf.offline else ttl)
+        if document is not None:
+            return document
+    document = fetch()
+    if document and conf.cache is not None:
+        conf.cache.put(kind, name, document)
+    return document
+
+
+def get(url, params=None, region='euw'):
+    """ Make a request to the api within the rate limits of the region.
+        Requests that hit the rate limit are retried after the time given
+        in Retry-After. Requests that time out, fail to connect or get a
+        5xx are retried conf.retries times with a jittered backoff, after
+        that the last response is returned or the error is raised """
+    limiter = conf.limiter(region)
+    retries = 0
+    while True:
+        with metrics.timer("api.throttle"):
+            limiter.acquire()
+        try:
+            with metrics.timer("api.request"):
+                response = riot_api.get(
+                    url, params=params, timeout=conf.timeout)
+        except (requests.Timeout, requests.ConnectionError):
+            metrics.count("api.errors")
+            if retries >= conf.retries:
+                raise
+        else:
+            metrics.count("api.requests")
+            metrics.count("api.status." + str(response.status_code))
+            metrics.count("api.bytes", len(response.content))
+            # Bytes read from the connection, before decompressing
+            metrics.count("api.transferred_bytes", response.raw.tell())
+            if response.status_code == 429:
+                metrics.count("api.rate_limited")
+                limiter.pause(float(response.headers.get("Retry-After", 1)))
+                continue
+            if response.status_code < 500 or retries >= conf.retries:
+                return response
+        retries += 1
+        metrics.count("api.retries")
+        time.sleep(conf.retry_backoff * 2 ** (retries - 1) *
+                   random.uniform(0.5, 1.5))
+
+
+def connection_stats():
+    """ Get the amount of connections opened to each host and the requests
+        made over them as (connections, requests) tuples keyed by the
+        host, a host with more requests than connections reused them """
+    stats = {}
+    if not riot_api.loaded:
+        return stats
+    for adapter in set(riot_api.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections, requests_made = stats.get(pool.host, (0, 0))
+            stats[pool.host] = (connections + pool.num_connections,
+                                requests_made + pool.num_requests)
+    return stats
+
+
+def count_connections():
+    """ Add the connection stats of each host to the metrics """
+    for host, (connections, requests_made) in connection_stats().items():
+        metrics.count("http.{0}.connections".format(host), connections)
+        metrics.count("http.{0}.requests".format(host), requests_made)
+
+
+def iter_download(function, arguments, progress_string):
+    """ Call the function with each of the arguments using
+        conf.concurrency threads and yield the results as they complete.
+        Only a few calls are queued ahead so the results that are waiting
+        to be consumed stay bounded """
+    arguments = list(arguments)
+    arguments_left = iter(arguments)
+    with ThreadPoolExecutor(max_workers=conf.concurrency) as executor:
+        pending = set()
+        done = 0
+        while True:
+            queued = conf.concurrency * 2 - len(pending)
+            for argument in islice(arguments_left, queued):
+                pending.add(executor.submit(function, argument))
+            if not pending:
+                return
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done += 1
+                print(progress_string.format(done, len(arguments)), end='\r')
+                yield future.result()
+
+
 def get_begin_time(days=1):
     """ Gets a timestamp from X days before now """
     beginTime = int((
@@ -51,11 +263,12 @@ def get_begin_time(days=1):
     return beginTime
 
 
-def get_challenger_summoner_ids():
+def get_challenger_summoner_ids(region='euw'):
     """ Get the summoner id's of players in challenger """
-    challengers = riot_api.get(
-        'https://euw.api.pvp.net/api/lol/euw/v2.5/league/challenger',
-        params={"type": "RANKED_SOLO_5x5"}
+    challengers = get(
+        conf.url(region, '/api/lol/{region}/v2.5/league/challenger'),
+        params={"type": "RANKED_SOLO_5x5"},
+        region=region
     )
     challengers = sorted(
         challengers.json()["entries"],
@@ -66,62 +279,144 @@ def get_challenger_summoner_ids():
     return summoner_ids
 
 
-def get_matches_from_summoner(summoner_id, days=1):
-    """ Download all the matches from a summoner in a certain timeframe """
-    matches = riot_api.get(
-        'https://euw.api.pvp.net/api/lol/euw/v2.2/matchlist/by-summoner/' +
+def get_matches_from_summoner(summoner_id, days=1, region='euw',
+                              begin_time=None, end_time=None):
+    """ Download all the matches from a summoner in a certain timeframe,
+        begin_time and end_time are timestamps in milliseconds that default
+        to the given days before now and to now """
+    if begin_time is None:
+        begin_time = get_begin_time(days)
+    if end_time is None:
+        end_time = int(time.time()) * 1000
+    response = get(
+        conf.url(region, '/api/lol/{region}/v2.2/matchlist/by-summoner/') +
         summoner_id,
         params={
             "type": "RANKED_SOLO_5x5",
-            "beginTime": get_begin_time(days),
-            "endTime": endTime,
+            "beginTime": begin_time,
+            "endTime": end_time,
             "beginIndex": 0,
             "endIndex": 200
-        })
-    try:
-        matches = matches.json()
-    except:
-        with open('error.log', 'w') as f:
-            f.write(matches.text)
-
-    if "matches" in matches:
-        return matches["matches"]
-    else:
+        },
+        region=region)
+    if response.status_code == 404:
+        # Summoners without games in the time frame
         return []
-
-
-def get_match_ids_from_challenger(summoner_ids, days=1):
-    """ Download the match id's from a list of summoner id's """
-    match_ids = set()
-    progress_string = "Retrieving matches from summoner {0} out of {1}"
-
-    for index, summoner_id in enumerate(summoner_ids, start=0):
-        print(progress_string.format(index, len(summoner_ids)), end='\r')
-        for match in get_matches_from_summoner(summoner_id, days):
-            match_ids.add(match["matchId"])
-        time.sleep(conf.wait_time)
-
-    return match_ids
-
-
-def get_match(match_id):
-    """ Download a match with this id """
-    match = riot_api.get(
-        'https://euw.api.pvp.net/api/lol/euw/v2.2/match/' + str(match_id),
-        params={"includeTimeline": "true"}
+    if response.status_code != 200:
+        raise ApiError("Matchlist of summoner {0} failed with status {1}".
+                       format(summoner_id, response.status_code))
+    try:
+        matches = response.json()
+    except ValueError:
+        raise ApiError("Unreadable matchlist of summoner {0}: {1!r}".format(
+            summoner_id, response.text[:200]))
+    return matches.get("matches", [])
+
+
+def get_match(match_id, region='euw'):
+    """ Download a match with this id, matches never change so they are
+        only downloaded once """
+    return cached(
+        "match", region + "/" + str(match_id),
+        lambda: download_match(match_id, region))
+
+
+def download_match(match_id, region='euw'):
+    """ Download a match with this id, raises ApiError if the api doesn't
+        give the match """
+    response = get(
+        conf.url(region, '/api/lol/{region}/v2.2/match/') + str(match_id),
+        params={"includeTimeline": "true"},
+        region=region
     )
+    if response.status_code != 200:
+        raise ApiError("Match {0} failed with status {1}".format(
+            match_id, response.status_code))
     try:
-        match = match.json()
-    except:
-        match = {}
-    return match
+        return parse_match(response.content)
+    except ValueError:
+        raise ApiError("Unreadable match {0}".format(match_id))
+
+
+# Fields of the match, the participants and the item purchase events that
+# are kept when a match is parsed
+MATCH_FIELDS = (
+    "matchId", "region", "platformId", "matchCreation", "matchDuration",
+    "matchVersion", "queueType", "matchMode", "matchType", "season",
+    "participants", "timeline")
+PARTICIPANT_FIELDS = (
+    "participantId", "championId", "teamId", "timeline", "stats")
+PURCHASE_FIELDS = ("eventType", "participantId", "itemId", "timestamp")
+
+
+def prune_match_object(obj):
+    """ Keep only the parts of a json object of a match that are loaded
+        to the database. Used as the object_hook of the decoder, so every
+        object is pruned right after it is decoded and the participant
+        frames and other events of the timeline never pile up in memory """
+    if "eventType" in obj:
+        if obj["eventType"] != "ITEM_PURCHASED":
+            return None
+        return {field: obj[field] for field in PURCHASE_FIELDS}
+    if "currentGold" in obj:
+        # Participant frame of a timeline frame
+        return None
+    if "participantFrames" in obj or "events" in obj:
+        return {
+            "timestamp": obj.get("timestamp"),
+            "events": [event for event in obj.get("events", ())
+                       if event is not None]
+        }
+    if "frames" in obj:
+        return {"frames": obj["frames"]}
+    if "participantId" in obj and "championId" in obj:
+        return {field: obj[field]
+                for field in PARTICIPANT_FIELDS if field in obj}
+    if "lane" in obj and "role" in obj:
+        return {"lane": obj["lane"], "role": obj["role"]}
+    if "winner" in obj and "teamId" not in obj:
+        # Stats of a participant
+        return {"winner": obj["winner"]}
+    if "matchId" in obj and "participants" in obj:
+        return {field: obj[field] for field in MATCH_FIELDS if field in obj}
+    return obj
+
+
+def parse_match(body):
+    """ Parse the body of a match response to a match with only the
+        metadata, the participants and the item purchase events """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    return json.loads(body, object_hook=prune_match_object)
+
+
+def get_versions():
+    """ Get the list of versions, newest first """
+    return cached(
+        "versions", "versions", download_versions, ttl=conf.versions_ttl)
+
+
+def download_versions():
+    """ Download the list of versions """
+    versions = riot_api.get(
+        'https://global.api.pvp.net/api/lol/static-data/euw/v1.2/versions',
+        timeout=conf.timeout
+    )
+    return versions.json()
 
 
 def get_champions():
+    """ Get the static champion data of the current version """
+    version = get_versions()[0]
+    return cached("champion", version, lambda: download_champions(version))
+
+
+def download_champions(version):
     """ Download the static champion data """
     champions = riot_api.get(
         'https://global.api.pvp.net/api/lol/static-data/euw/v1.2/champion',
-        params={'dataById': True}
+        params={'dataById': True, 'version': version},
+        timeout=conf.timeout
     )
     if champions.status_code != 200:
         print(champions.text)
@@ -130,22 +425,29 @@ def get_champions():
 
 
 def get_items():
+    """ Get the static item data of the current version """
+    version = get_versions()[0]
+    return cached("item", version, lambda: download_items(version))
+
+
+def download_items(version):
     """ Download the static item data """
     items = riot_api.get(
         'https://global.api.pvp.net/api/lol/static-data/euw/v1.2/item',
-        params={'itemListData': 'depth,into,tags'}
+        params={'itemListData': 'depth,into,tags', 'version': version},
+        timeout=conf.timeout
     )
     return items.json()
 
 
-def get_matches(match_ids):
+def iter_matches(match_ids, region='euw'):
+    """ Download the matches in the given id list, yielding each match
+        as soon as it has been downloaded """
+    return iter_download(
+        lambda match_id: get_match(match_id, region), match_ids,
+        region.upper() + ": Retrieving match {0} out {1}")
+
+
+def get_matches(match_ids, region='euw'):
     """ Download all the match in the given id lists """
-    matches = []
-    for index, id in enumerate(match_ids):
-        print(
-            "Retrieving match {0} out {1}".format(index, len(match_ids)),
-            end='\r'
-        )
-        matches.append(get_match(id))
-        time.sleep(conf.wait_time)
-    return matches
+    return list(iter_matches(match_ids, region))
@@ -0,0 +1,284 @@
+""" Snapshots of the matches, champions and bought items tables as typed
+    numpy column files for fast offline analysis. Export one with:
+
+        python snapshot.py snapshot/
+
+    The champion keys, item ids, versions and regions are stored as integer
+    codes into the lists in codes.json, the code of an id is its index in
+    the sorted list. The columns are loaded memory mapped.
+"""
+from data import (
+    engine, Match, Champion, BoughtItems, STARTING_ITEMS_TIME, champion_keys)
+from analyze import BuildAnalyzer, current_version
+from sqlalchemy.sql import select, func, cast
+from sqlalchemy import Integer
+from datetime import datetime, timedelta
+import numpy as np
+import argparse
+import json
+import os
+import re
+
+# Columns of each table and their types
+COLUMNS = {
+    "matches": {
+        "match_id": np.int64,
+        # Seconds since the epoch
+        "created_on": np.int64,
+        "version": np.int16,
+        "region": np.int8,
+    },
+    "champions": {
+        # Row of the match in the matches columns
+        "match": np.int32,
+        "participant_id": np.int8,
+        "champion": np.int16,
+        # 1 for a win, 0 for a loss and -1 for an unknown outcome
+        "winner": np.int8,
+    },
+    "bought_items": {
+        # Row of the participant in the champions columns
+        "participant": np.int32,
+        "item": np.int16,
+        # Milliseconds from the start of the match
+        "timestamp": np.int32,
+    },
+}
+
+# Rows fetched from the database at a time
+CHUNK_SIZE = 100000
+
+
+def column_path(directory, table, column):
+    return os.path.join(directory, "{0}.{1}.npy".format(table, column))
+
+
+def fetch_columns(conn, query, count):
+    """ Read the rows of a query to a numpy array per column """
+    result = conn.execute(query)
+    chunks = []
+    while True:
+        rows = result.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        chunks.append(rows)
+    return [
+        np.array([row[column] for rows in chunks for row in rows])
+        for column in range(count)]
+
+
+def codes_of(values, codes):
+    """ Replace values with their index in the sorted list of codes """
+    return np.searchsorted(np.array(codes), values)
+
+
+def match_keys(match_ids, regions, region_codes):
+    """ Keys of the matches that are unique in every region and sort like
+        the matches ordered by the region and the match id """
+    return codes_of(regions, region_codes).astype(np.int64) * 2 ** 40 + \
+        match_ids
+
+
+def export_snapshot(directory):
+    """ Write the matches, champions and bought items tables to column
+        files in the directory """
+    os.makedirs(directory, exist_ok=True)
+    created_on = cast(func.strftime('%s', Match.created_on), Integer)
+    with engine.connect() as conn:
+        match_ids, created, versions, regions = fetch_columns(conn, select([
+            Match.match_id, created_on, Match.version, Match.region]).
+            order_by(Match.region, Match.match_id), 4)
+        (champion_match_ids, champion_regions, participant_ids, keys,
+         winners) = fetch_columns(conn, select([
+             Champion.match_id, Champion.region, Champion.participant_id,
+             Champion.champion_key, Champion.winner]).
+            order_by(Champion.region, Champion.match_id,
+                     Champion.participant_id), 5)
+        (item_match_ids, item_regions, item_participant_ids, item_ids,
+         timestamps) = fetch_columns(conn, select([
+             BoughtItems.match_id, BoughtItems.region,
+             BoughtItems.participant_id, BoughtItems.item_id,
+             BoughtItems.timestamp]), 5)
+
+    codes = {
+        "versions": sorted(set(versions.tolist())),
+        "regions": sorted(set(regions.tolist())),
+        "champions": sorted(set(keys.tolist())),
+        "items": sorted(set(item_ids.tolist())),
+    }
+
+    # Participants are found by their match and participant id, rows
+    # without a match or a participant are left out like in a join
+    champion_matches = match_keys(
+        champion_match_ids, champion_regions, codes["regions"])
+    participant_keys = champion_matches * 16 + participant_ids
+    champion_match = np.searchsorted(
+        match_keys(match_ids, regions, codes["regions"]), champion_matches)
+    item_keys = match_keys(
+        item_match_ids, item_regions, codes["regions"]) * 16 + \
+        item_participant_ids
+    participant = np.searchsorted(participant_keys, item_keys)
+    if len(participant_keys):
+        participant = np.minimum(participant, len(participant_keys) - 1)
+        found = participant_keys[participant] == item_keys
+    else:
+        found = np.zeros(len(item_keys), dtype=bool)
+
+    columns = {
+        "matches": {
+            "match_id": match_ids,
+            "created_on": created,
+            "version": codes_of(versions, codes["versions"]),
+            "region": codes_of(regions, codes["regions"]),
+        },
+        "champions": {
+            "match": champion_match,
+            "participant_id": participant_ids,
+            "champion": codes_of(keys, codes["champions"]),
+            "winner": np.array([-1 if winner is None else int(winner)
+                                for winner in winners.tolist()]),
+        },
+        "bought_items": {
+            "participant": participant[found],
+            "item": codes_of(item_ids[found], codes["items"]),
+            "timestamp": timestamps[found],
+        },
+    }
+    for table, table_columns in columns.items():
+        for column, values in table_columns.items():
+            np.save(column_path(directory, table, column),
+                    values.astype(COLUMNS[table][column]))
+    with open(os.path.join(directory, "codes.json"), "w") as f:
+        json.dump(codes, f)
+
+
+class Snapshot:
+    """ The columns of an exported snapshot, memory mapped """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "codes.json")) as f:
+            self.codes = json.load(f)
+        for table, columns in COLUMNS.items():
+            setattr(self, table, {
+                column: np.load(column_path(directory, table, column),
+                                mmap_mode="r")
+                for column in columns})
+
+
+def outcome_counts(keys, winner, minlength):
+    """ Count the keys, the keys of won games and the keys of games with a
+        known outcome, the counts are on the last axis """
+    return np.stack([
+        np.bincount(keys, minlength=minlength),
+        np.bincount(keys, weights=winner == 1, minlength=minlength),
+        np.bincount(keys, weights=winner >= 0, minlength=minlength)
+    ], axis=-1).astype(np.int64)
+
+
+def like(pattern, values):
+    """ Indexes of the values that match an sql like pattern """
+    expression = re.compile("".join(
+        ".*" if char == "%" else "." if char == "_" else re.escape(char)
+        for char in pattern) + "$", re.IGNORECASE | re.DOTALL)
+    return [index for index, value in enumerate(values)
+            if expression.match(value)]
+
+
+class SnapshotAnalyzer:
+    """ Analyzes the builds of many champions at once from a snapshot.
+        Gives the same BuildAnalyzers as the BatchAnalyzer, the counts are
+        summed with numpy over the columns instead of queried from the
+        database """
+
+    def __init__(self, snapshot, days=1, championKeys=None, regions=None):
+        self.snapshot = snapshot
+        self.days = days
+        if championKeys is None:
+            championKeys = champion_keys()
+        self.championKeys = championKeys
+        self.regions = regions
+
+    def match_mask(self, since):
+        """ The matches in the time window and the regions """
+        matches = self.snapshot.matches
+        since = (since - datetime(1970, 1, 1)).total_seconds()
+        mask = matches["created_on"] > since
+        if self.regions is not None:
+            regions = [self.snapshot.codes["regions"].index(region.upper())
+                       for region in self.regions
+                       if region.upper() in self.snapshot.codes["regions"]]
+            mask &= np.isin(matches["region"], regions)
+        return mask
+
+    def counts(self, since):
+        """ Get the amount of games played by each champion and the amount
+            of times each item has been bought by each champion as arrays
+            indexed by the champion code, late and the item code. The last
+            axis has the amount, the wins and the games with a known
+            outcome """
+        codes = self.snapshot.codes
+        champions = self.snapshot.champions
+        bought_items = self.snapshot.bought_items
+        matches = self.match_mask(since)
+
+        in_window = matches[champions["match"]]
+        games = outcome_counts(
+            champions["champion"][in_window],
+            champions["winner"][in_window], len(codes["champions"]))
+
+        matches &= np.isin(
+            self.snapshot.matches["version"],
+            like(current_version.load(), codes["versions"]))
+        participant = bought_items["participant"]
+        timestamp = bought_items["timestamp"]
+        mask = matches[champions["match"][participant]] & \
+            (timestamp != STARTING_ITEMS_TIME)
+        late = (timestamp[mask] > STARTING_ITEMS_TIME).astype(np.int64)
+        champion = champions["champion"][participant[mask]].astype(np.int64)
+        key = (champion * 2 + late) * len(codes["items"]) + \
+            bought_items["item"][mask]
+        item_counts = outcome_counts(
+            key, champions["winner"][participant[mask]],
+            len(codes["champions"]) * 2 * len(codes["items"]))
+        return games, item_counts.reshape(
+            len(codes["champions"]), 2, len(codes["items"]), 3)
+
+    def analyzers(self):
+        """ Returns a dict of BuildAnalyzers keyed by the champion key """
+        since = datetime.utcnow() - timedelta(days=self.days)
+        games, item_counts = self.counts(since)
+        codes = self.snapshot.codes
+        item_ids = np.array(codes["items"])
+
+        analyzers = {}
+        for key in self.championKeys:
+            if key not in codes["champions"]:
+                analyzers[key] = BuildAnalyzer.from_counts(
+                    key, self.days, 0, [], [])
+                continue
+            champion = codes["champions"].index(key)
+            counts = []
+            for late in (0, 1):
+                bought = np.flatnonzero(item_counts[champion, late, :, 0])
+                # Same order as the queries, by the count and the item id
+                order = np.lexsort((
+                    item_ids[bought], item_counts[champion, late, bought, 0]))
+                counts.append([
+                    (int(item_ids[item]),) +
+                    tuple(int(count)
+                          for count in item_counts[champion, late, item])
+                    for item in bought[order]])
+            game_count, wins, decided = (int(count)
+                                         for count in games[champion])
+            analyzers[key] = BuildAnalyzer.from_counts(
+                key, self.days, game_count, *counts,
+                winRate=wins / decided if decided else None)
+        return analyzers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "directory", help="Directory to write the column files to")
+    args = parser.parse_args()
+    export_snapshot(args.directory)
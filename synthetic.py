@@ -0,0 +1,227 @@
+""" Deterministic synthetic matches in the shape returned by
+    riot_api.get_match and static data in the shape of the static data
+    api, for benchmarking without an api key """
+from random import Random
+
+# Timestamp of the first synthetic match in milliseconds
+START_TIME = 1467331200000
+# Versions of the synthetic static data, newest first
+VERSIONS = ["6.13.1", "6.12.1"]
+# Tags of the synthetic items that are bought for offense and for defense
+OFFENSIVE_TAGS = [
+    "Damage", "SpellDamage", "AttackSpeed", "CriticalStrike", "LifeSteal"]
+DEFENSIVE_TAGS = ["Armor", "Health", "SpellBlock", "HealthRegen"]
+
+
+# Events of the timeline other than item purchases
+OTHER_EVENTS = [
+    "SKILL_LEVEL_UP", "WARD_PLACED", "WARD_KILL", "CHAMPION_KILL",
+    "ITEM_DESTROYED", "ITEM_SOLD", "ITEM_UNDO", "BUILDING_KILL",
+    "ELITE_MONSTER_KILL"]
+# Fields of the stats of a participant, besides winner
+STAT_FIELDS = [
+    "champLevel", "kills", "deaths", "assists", "minionsKilled",
+    "neutralMinionsKilled", "goldEarned", "goldSpent", "totalDamageDealt",
+    "totalDamageTaken", "totalHeal", "largestKillingSpree",
+    "largestMultiKill", "killingSprees", "magicDamageDealt",
+    "physicalDamageDealt", "trueDamageDealt", "magicDamageTaken",
+    "physicalDamageTaken", "trueDamageTaken", "totalTimeCrowdControlDealt",
+    "wardsPlaced", "wardsKilled", "sightWardsBoughtInGame",
+    "visionWardsBoughtInGame", "towerKills", "inhibitorKills",
+    "doubleKills", "tripleKills", "quadraKills", "pentaKills",
+    "item0", "item1", "item2", "item3", "item4", "item5", "item6"]
+# Deltas of the timeline of a participant
+DELTA_FIELDS = [
+    "creepsPerMinDeltas", "xpPerMinDeltas", "goldPerMinDeltas",
+    "csDiffPerMinDeltas", "xpDiffPerMinDeltas", "damageTakenPerMinDeltas",
+    "damageTakenDiffPerMinDeltas"]
+
+
+def synthetic_match(match_id, champion_ids, item_ids,
+                    created_on=START_TIME, version="6.13.1.1", full=False):
+    """ Create a match with a timeline of item purchases.
+        The same match_id always gives the same match. A full match also
+        has the rest of what the api sends: participant stats, identities,
+        teams, participant frames and the other events of the timeline.
+        The parts that are loaded to the database are the same either way """
+    random = Random(match_id)
+    champions = random.sample(champion_ids, 10)
+    winner = random.choice([100, 200])
+    participants = []
+    for participant_id, champion_id in enumerate(champions, start=1):
+        team_id = 100 if participant_id <= 5 else 200
+        participants.append({
+            "participantId": participant_id,
+            "championId": champion_id,
+            "teamId": team_id,
+            "stats": {"winner": team_id == winner},
+            "timeline": {
+                "role": random.choice(["SOLO", "NONE", "DUO_CARRY",
+                                       "DUO_SUPPORT"]),
+                "lane": random.choice(["TOP", "MIDDLE", "JUNGLE",
+                                       "BOTTOM"])
+            }
+        })
+
+    duration = random.randint(20 * 60, 45 * 60)
+    frames = []
+    for minute in range(duration // 60 + 1):
+        events = []
+        for participant_id in range(1, 11):
+            # Starting items are all bought in the first minute
+            purchases = 3 if minute == 0 else random.randint(0, 1)
+            for purchase in range(purchases):
+                events.append({
+                    "eventType": "ITEM_PURCHASED",
+                    "participantId": participant_id,
+                    "itemId": random.choice(item_ids),
+                    "timestamp": minute * 60000 + random.randint(0, 59999)
+                })
+        events.sort(key=lambda event: event["timestamp"])
+        frames.append({"timestamp": minute * 60000, "events": events})
+
+    match = {
+        "matchId": match_id,
+        "region": "EUW",
+        "matchCreation": created_on,
+        "matchDuration": duration,
+        "matchVersion": version,
+        "participants": participants,
+        "timeline": {"frames": frames}
+    }
+    if full:
+        add_full_match_parts(match, Random(-match_id))
+    return match
+
+
+def add_full_match_parts(match, random):
+    """ Add the parts of a match that aren't loaded to the database """
+    for participant in match["participants"]:
+        if participant["stats"]["winner"]:
+            winner = participant["teamId"]
+        participant.update({
+            "spell1Id": random.randint(1, 14),
+            "spell2Id": random.randint(1, 14),
+            "highestAchievedSeasonTier": "CHALLENGER",
+            "masteries": [
+                {"masteryId": 6000 + index, "rank": random.randint(1, 5)}
+                for index in range(12)],
+            "runes": [
+                {"runeId": 5000 + index, "rank": random.randint(1, 9)}
+                for index in range(8)],
+        })
+        participant["stats"].update(
+            {field: random.randint(0, 30000) for field in STAT_FIELDS})
+        participant["timeline"].update({
+            field: {"zeroToTen": random.random() * 10,
+                    "tenToTwenty": random.random() * 10,
+                    "twentyToThirty": random.random() * 10}
+            for field in DELTA_FIELDS})
+    match["participantIdentities"] = [
+        {"participantId": participant_id,
+         "player": {"summonerId": random.randint(1, 10 ** 8),
+                    "summonerName": "Summoner{0}".format(participant_id),
+                    "matchHistoryUri": "/v1/stats/player_history/EUW/1",
+                    "profileIcon": random.randint(1, 1000)}}
+        for participant_id in range(1, 11)]
+    match["teams"] = [
+        {"teamId": team_id, "winner": team_id == winner,
+         "firstBlood": random.random() < 0.5,
+         "towerKills": random.randint(0, 11),
+         "bans": [{"championId": random.randint(1, 400), "pickTurn": turn}
+                  for turn in range(3)]}
+        for team_id in (100, 200)]
+
+    for frame in match["timeline"]["frames"]:
+        frame["participantFrames"] = {
+            str(participant_id): {
+                "participantId": participant_id,
+                "position": {"x": random.randint(0, 15000),
+                             "y": random.randint(0, 15000)},
+                "currentGold": random.randint(0, 5000),
+                "totalGold": random.randint(0, 20000),
+                "level": random.randint(1, 18),
+                "xp": random.randint(0, 20000),
+                "minionsKilled": random.randint(0, 300),
+                "jungleMinionsKilled": random.randint(0, 100),
+                "dominionScore": 0,
+                "teamScore": 0}
+            for participant_id in range(1, 11)}
+        events = frame["events"]
+        for index in range(random.randint(10, 40)):
+            events.append({
+                "eventType": random.choice(OTHER_EVENTS),
+                "participantId": random.randint(1, 10),
+                "killerId": random.randint(0, 10),
+                "victimId": random.randint(0, 10),
+                "assistingParticipantIds": random.sample(range(1, 11), 3),
+                "position": {"x": random.randint(0, 15000),
+                             "y": random.randint(0, 15000)},
+                "skillSlot": random.randint(1, 4),
+                "wardType": "YELLOW_TRINKET",
+                "timestamp": frame["timestamp"] + random.randint(0, 59999)
+            })
+        events.sort(key=lambda event: event["timestamp"])
+    match["timeline"]["frameInterval"] = 60000
+
+
+def synthetic_matches(count, champion_ids, item_ids, created_on=START_TIME,
+                      version="6.13.1.1", start=1, full=False,
+                      spacing=60000):
+    """ Yield count synthetic matches spacing milliseconds apart, the
+        match ids are counted from start """
+    for index, match_id in enumerate(range(start, start + count)):
+        yield synthetic_match(
+            match_id, champion_ids, item_ids,
+            created_on=created_on + index * spacing, version=version,
+            full=full)
+
+
+def synthetic_champions(count=130, version=VERSIONS[0]):
+    """ Static champion data of count champions, keyed by the id """
+    return {
+        "type": "champion",
+        "version": version,
+        "data": {
+            str(champion_id): {
+                "id": champion_id,
+                "key": "Champion{0:03d}".format(champion_id),
+                "name": "Champion {0}".format(champion_id),
+                "title": "the Synthetic"
+            }
+            for champion_id in range(1, count + 1)
+        }
+    }
+
+
+def synthetic_items(count=250, version=VERSIONS[0]):
+    """ Static item data of count items. Of every ten items four are
+        components, four are final items built from the components, one
+        is a consumable and one is a pair of boots """
+    random = Random(count)
+    item_ids = list(range(1001, 1001 + count))
+    finals = [item_id for index, item_id in enumerate(item_ids)
+              if 4 <= index % 10 < 8]
+    items = {}
+    for index, item_id in enumerate(item_ids):
+        kind = index % 10
+        item = {"id": item_id, "name": "Item {0}".format(item_id)}
+        if kind < 4:
+            tags = OFFENSIVE_TAGS if kind % 2 == 0 else DEFENSIVE_TAGS
+            item["tags"] = random.sample(tags, 1)
+            item["into"] = [str(final) for final in random.sample(
+                finals, min(2, len(finals)))]
+            item["depth"] = 1
+        elif kind < 8:
+            tags = OFFENSIVE_TAGS if kind % 2 == 0 else DEFENSIVE_TAGS
+            item["tags"] = random.sample(tags, 2)
+            item["depth"] = 2
+        elif kind == 8:
+            item["tags"] = ["Consumable"]
+        else:
+            item["tags"] = ["Boots"]
+        items[str(item_id)] = item
+    for item in items.values():
+        for final in item.get("into", []):
+            items[final].setdefault("from", []).append(str(item["id"]))
+    return {"type": "item", "version": version, "data": items}